@@ -0,0 +1,179 @@
+from initialize import archive_path
+from utils import claim_lock
+import index
+import logging
+import os
+import time
+import zlib
+import gzip
+from contextlib import contextmanager
+from typing import Iterator
+
+# The archive keeps the index records of completed downloads, which are
+# cleared from the index, so that a track can be queued again without
+# matching it again. Each record is one gzip member appended to archive.gz;
+# archive.idx maps the URIs of a record to the offset and length of its
+# member, one tab-separated line per URI. Later lines supersede earlier ones.
+
+offsets_path = archive_path.with_suffix('.idx')
+lock_path = archive_path.with_suffix('.lock')
+
+# Offsets read so far, and the size of the offsets file they were read from
+_offsets = {}
+_offsets_size = 0
+
+
+@contextmanager
+def _locked(poll_seconds: float = 0.1):
+    # Serializes appends between daemons
+    while not claim_lock(lock_path):
+        time.sleep(poll_seconds)
+    try:
+        yield
+    finally:
+        try:
+            lock_path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def offsets() -> dict:
+    """
+    Returns the offsets of the archived records by URI. Only lines appended
+    since the last call are read.
+
+    :return:    A dictionary of URI to (offset, length) of the gzip member.
+    """
+    global _offsets_size
+    if not offsets_path.is_file():
+        if archive_path.is_file() and archive_path.stat().st_size:
+            rebuild_offsets()
+        else:
+            return _offsets
+    with open(offsets_path, 'rb') as f:
+        f.seek(_offsets_size)
+        for line in f:
+            if not line.endswith(b'\n'):
+                # Partially written by a concurrent append
+                break
+            _offsets_size += len(line)
+            uri, offset, length = line.decode('utf-8').rstrip('\n').split('\t')
+            _offsets[uri] = (int(offset), int(length))
+    return _offsets
+
+
+def rebuild_offsets() -> None:
+    """
+    Rebuilds the offsets file by walking the gzip members of the archive.
+
+    :return:    None.
+    """
+    global _offsets_size
+    data = archive_path.read_bytes()
+    lines = []
+    offset = 0
+    while offset < len(data):
+        member = zlib.decompressobj(wbits=31)
+        try:
+            record = index.loads(member.decompress(data[offset:]))
+        except (zlib.error, ValueError):
+            record = None
+        if record is None or not member.eof:
+            # A torn append at the end of the archive
+            break
+        length = len(data) - offset - len(member.unused_data)
+        for uri in [record['uri'], *record.get('aliases', ())]:
+            lines.append(f'{uri}\t{offset}\t{length}\n')
+        offset += length
+    index._replace(''.join(lines).encode('utf-8'), offsets_path)
+    _offsets.clear()
+    _offsets_size = 0
+
+
+def has_uri(uri: str) -> bool:
+    return uri in offsets()
+
+
+def read(uri: str) -> dict | None:
+    """
+    Reads an archived record.
+
+    :param uri:     URI of the track, or of the source of its tags.
+    :return:        The record as returned by index.read, with its uri, or None
+                    if the URI is not archived.
+    """
+    location = offsets().get(uri)
+    if location is None:
+        return None
+    offset, length = location
+    with open(archive_path, 'rb') as f:
+        f.seek(offset)
+        return index.loads(gzip.decompress(f.read(length)))
+
+
+def records() -> Iterator[dict]:
+    """
+    Yields the latest archived record of each track.
+
+    :return:    Iterator of records, see read.
+    """
+    locations = offsets()
+    if not locations:
+        return
+    with open(archive_path, 'rb') as f:
+        for offset, length in sorted(set(locations.values())):
+            f.seek(offset)
+            record = index.loads(gzip.decompress(f.read(length)))
+            if locations.get(record['uri']) == (offset, length):
+                yield record
+
+
+def append(uri: str, record: dict, aliases=(), logger: logging.Logger | None = None) -> None:
+    """
+    Appends the index record of a completed download to the archive.
+
+    :param uri:     URI of the index item
+    :param record:  The record as returned by index.read
+    :param aliases: Further URIs to find the record by, e.g. of the source of
+                    the tags
+    :param logger:  logging object
+    :return:        None.
+    """
+    logger = logger or logging.getLogger(__name__)
+    aliases = [a for a in dict.fromkeys(aliases) if a and a != uri]
+    record = dict(record, uri=uri, aliases=aliases, archived=time.time())
+    record.pop('queue', None)
+    member = gzip.compress(index.dumps(record), mtime=0)
+    with _locked():
+        # Records the offsets only once the member is on disk
+        with open(archive_path, 'ab') as f:
+            offset = f.tell()
+            f.write(member)
+            f.flush()
+            os.fsync(f.fileno())
+        with open(offsets_path, 'ab') as f:
+            f.write(''.join(f'{u}\t{offset}\t{len(member)}\n' for u in [uri, *aliases]).encode('utf-8'))
+    logger.info('Archived the index item of %s (%d bytes)', uri, len(member))
+
+
+def restore(uri: str, priority: int = index.interactive_priority) -> str:
+    """
+    Queues an archived track again from its archived record, without matching.
+
+    :param uri:         URI of the track, or of the source of its tags
+    :param priority:    Download priority
+    :return:            Status message
+    """
+    record = read(uri)
+    if record is None:
+        return f'Failed: NotArchived "{uri}"'
+    index.write(record['uri'], tags=record['tags'], settings=record['settings'],
+                alternates=record.get('alternates'), priority=priority)
+    return f'Success: Download restored.\n' \
+           f'    -> AUDIO {record["uri"]}'
+
+
+if __name__ == '__main__':
+    n_tracks = sum(1 for _ in records())
+    print('tracks'.ljust(20), n_tracks)
+    print('bytes'.ljust(20), archive_path.stat().st_size if archive_path.is_file() else 0)
@@ -1,15 +1,31 @@
-from initialize import music_dir, daemon_dir, log_dir, disp_daemons, glob, Path
+from initialize import music_dir, daemon_dir, album_lock_dir, log_dir, staging_dir, cache_dir, disp_daemons, glob, \
+    Path, \
+    download_stall_timeout, download_task_timeout, retry_base_seconds, retry_max_seconds, retry_max_attempts, \
+    supervisor_path, desired_daemons_path, interactive_daemon_path, autoscale_interval, autoscale_load_limit
 
+import hashlib
 import logging
+import queue
+import random
+import shutil
 import subprocess
+import threading
 import time
-from utils import get_url_platform, get_path_components, track_exists, clip_path_length, call_with_backoff
+from datetime import datetime
+from utils import get_url_platform, get_path_components, track_exists, clip_path_length, call_with_backoff, \
+    json_in, json_out, pid_is_alive, kill_child_processes, classify_error, DownloadFailed, claim_lock, lock_owner, \
+    is_throttled
 import os
 import index
-from tag_manager import download_cover_img, set_file_tags
+import raw_cache
+import archive
+from tag_manager import download_cover_img, write_id3_header, ffmetadata, get_tags_uri
+from transcode import transcode, copyable_codecs
 import atexit
 import sys
 import click
+from contextlib import contextmanager
+from typing import Iterable
 
 
 class LockFile:
@@ -19,10 +35,11 @@ class LockFile:
     expect daemon/task markers to exist under daemon_dir.
     """
 
-    def __init__(self, path: Path):
+    def __init__(self, path: Path, claim: bool = True):
         self.path = Path(path)
-        self.path.parent.mkdir(parents=True, exist_ok=True)
-        self.touch()
+        if claim:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.touch()
 
     def touch(self) -> None:
         # write pid; also updates mtime (used by optional stale checks)
@@ -41,12 +58,313 @@ class LockFile:
             return False
 
 
-def download_track(track_uri: str, logger: logging.Logger | None = None) -> None:
+    def is_orphaned(self) -> bool:
+        # The process that created the marker no longer exists
+        try:
+            pid = int(self.path.read_text(encoding="utf-8") or 0)
+        except (FileNotFoundError, ValueError):
+            return False
+        return not pid_is_alive(pid)
+
+
+class TaskStaging:
+    """Per-task staging directory with resume metadata.
+
+    Partial downloads of a task are kept in STAGING_DIR/<task uri>, next to a
+    resume.json that records which stages (artist, cover, source, audio) have
+    been completed. When a task is reclaimed after its daemon died, completed
+    stages are skipped and the source download continues where it stopped.
     """
-    This handles downloading audio from YouTube and setting the right mp3 tags.
+
+    def __init__(self, task_uri: str):
+        self.path = Path(staging_dir / task_uri)
+        self.meta_path = self.path / "resume.json"
+        self.meta = json_in(self.meta_path) if self.meta_path.is_file() else {}
+        self.meta = self.meta or {}
+
+    def is_done(self, stage: str) -> bool:
+        return bool(self.meta.get(stage))
+
+    def get(self, stage: str) -> dict | None:
+        value = self.meta.get(stage)
+        return value if isinstance(value, dict) else None
+
+    def complete(self, stage: str, info: dict | bool = True) -> None:
+        self.meta[stage] = info
+        self.path.mkdir(parents=True, exist_ok=True)
+        json_out(self.meta, self.meta_path)
+
+    def clear(self) -> None:
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def produced_path(audio_uri: str) -> Path:
+    """Path of the record of the files that were produced from the audio of audio_uri."""
+    return Path(cache_dir / "produced" / f"{audio_uri}.json")
+
+
+def record_produced(audio_uri: str, file_path: Path, audio_format: str, quality: int) -> None:
+    """Remember that file_path holds the audio of audio_uri, so that it can be reused."""
+    path = produced_path(audio_uri)
+    entries = (json_in(path) if path.is_file() else None) or []
+    entries = [e for e in entries if e["path"] != str(file_path)]
+    entries.append({"path": str(file_path), "audio_format": audio_format, "quality": quality})
+    path.parent.mkdir(parents=True, exist_ok=True)
+    json_out(entries, path)
+
+
+def find_produced(audio_uri: str, audio_format: str, quality: int) -> Path | None:
+    """Return an existing file with the audio of audio_uri in the given format and quality, if any."""
+    path = produced_path(audio_uri)
+    entries = (json_in(path) if path.is_file() else None) or []
+    for entry in entries:
+        if entry["audio_format"] == audio_format and entry["quality"] == quality and os.path.isfile(entry["path"]):
+            return Path(entry["path"])
+    return None
+
+
+def publish(source: Path, target: Path, chunk_size: int = 8 * 1024 * 1024) -> int:
+    """Move a finished file from the staging directory into MUSIC_DIR.
+
+    The file is copied sequentially to a hidden temporary name next to the
+    target and then renamed, so the target directory never holds a partial
+    file. The source stays in the staging directory until the task concludes.
+
+    :param source:      Path of the finished file
+    :param target:      Path to publish the file at
+    :param chunk_size:  Bytes per write
+    :return:            Number of bytes published
+    """
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_name(f".{target.name}.{os.getpid()}.part")
+    try:
+        with open(source, "rb") as src, open(tmp, "wb") as dst:
+            shutil.copyfileobj(src, dst, chunk_size)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp, target)
+    except BaseException:
+        try:
+            tmp.unlink()
+        except FileNotFoundError:
+            pass
+        raise
+    return target.stat().st_size
+
+
+class Mover:
+    """Background thread that publishes finished files to MUSIC_DIR.
+
+    Daemons hand their finished audio files over and continue with the next
+    task. The mover publishes the files that queued up in one sequential
+    batch, then calls each file's on_done callback, or its on_error callback
+    when publishing or on_done failed.
+    """
+
+    def __init__(self, logger: logging.Logger | None = None):
+        self.logger = logger or logging.getLogger(__name__)
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, source: Path, target: Path, on_done=None, on_error=None,
+               logger: logging.Logger | None = None) -> None:
+        self._queue.put((source, target, on_done, on_error, logger or self.logger))
+
+    def close(self) -> None:
+        """Publish all submitted files and stop the thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            start = time.monotonic()
+            n_files = n_bytes = 0
+            for job in batch:
+                if job is None:
+                    continue
+                source, target, on_done, on_error, logger = job
+                error = None
+                try:
+                    n_bytes += publish(source, target)
+                    n_files += 1
+                    logger.info('Published "%s"', target)
+                except Exception as e:
+                    logger.exception('Publishing "%s" failed', target)
+                    error = e
+                # A failing callback must not stop the files queued after it
+                if error is None and on_done is not None:
+                    try:
+                        on_done()
+                    except Exception as e:
+                        logger.exception('Concluding "%s" failed', target)
+                        error = e
+                if error is not None and on_error is not None:
+                    try:
+                        on_error(error)
+                    except Exception:
+                        logger.exception('Recording the failure of "%s" failed', target)
+            if n_files:
+                self.logger.info("Published %d file(s), %d bytes in %.1fs",
+                                 n_files, n_bytes, time.monotonic() - start)
+            if None in batch:
+                return
+
+
+def album_key(mp3_tags: dict) -> str:
+    # Identifies the album directory a track is stored in
+    album = f"{mp3_tags.get('album_artist')}/{mp3_tags.get('album')}"
+    return hashlib.sha1(album.encode("utf-8")).hexdigest()[:16]
+
+
+def album_in_setup(key: str) -> bool:
+    # True if another live daemon is setting up the album's directory and assets
+    owner = lock_owner(album_lock_dir.format(key))
+    return owner is not None and owner != os.getpid() and pid_is_alive(owner)
+
+
+@contextmanager
+def album_setup(key: str, poll_seconds: float = 1, logger: logging.Logger | None = None):
+    """
+    Serializes the setup of an album directory and its shared assets (artist
+    image, cover) between daemons. The first daemon to reach an album does the
+    setup; a daemon that reaches it at the same time waits and then finds the
+    assets in place.
+
+    :param key:             Album key, see album_key
+    :param poll_seconds:    Seconds to wait between attempts to claim the lock.
+    :param logger:          logging object
+    """
+    logger = logger or logging.getLogger(__name__)
+    lock_path = album_lock_dir.format(key)
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    waiting_since = time.monotonic()
+    while not claim_lock(lock_path):
+        time.sleep(poll_seconds)
+    waited = time.monotonic() - waiting_since
+    if waited >= poll_seconds:
+        logger.info("Waited %.1fs for another daemon to set up the album", waited)
+    try:
+        yield
+    finally:
+        try:
+            lock_path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class Watchdog:
+    """Hard deadlines for the download task running in the daemon's main thread.
+
+    A background thread watches the task. The task expires when nothing in
+    the staging directories of the task and its alternate candidates grows or
+    changes for stall_seconds, including before the first byte arrives, or
+    when the whole task takes longer than total_seconds. On expiry the
+    watchdog kills the daemon's child processes (FFmpeg, deno), records a
+    (transient) timeout outcome in the index, calls on_hung and exits the
+    daemon. The task's claim is left to the stale-PID takeover (see
+    claim_lock), so no other daemon can claim the task while this one is
+    still in it.
+    """
+
+    def __init__(self, task_uri: str, stall_seconds: float, total_seconds: float,
+                 logger: logging.Logger | None = None, on_hung=None, watch_uris: Iterable[str] = (),
+                 poll_seconds: float = 5):
+        self.task_uri = task_uri
+        self.stall_seconds = stall_seconds
+        self.total_seconds = total_seconds
+        self.logger = logger or logging.getLogger(__name__)
+        self.on_hung = on_hung
+        self.staging_dirs = [staging_dir / uri for uri in dict.fromkeys([task_uri, *watch_uris]) if uri]
+        self.poll_seconds = poll_seconds
+        self.expired: str | None = None
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._done.set()
+        self._thread.join()
+
+    def _activity(self) -> tuple | None:
+        # Total size and latest change of the staged files, e.g. partial
+        # downloads and FFmpeg output; None while nothing is staged
+        n_bytes, last_change, n_files = 0, 0, 0
+        for directory in self.staging_dirs:
+            for p in directory.rglob("*"):
+                try:
+                    st = p.stat()
+                except FileNotFoundError:
+                    continue
+                if p.is_file():
+                    n_bytes += st.st_size
+                    last_change = max(last_change, st.st_mtime_ns)
+                    n_files += 1
+        return (n_bytes, last_change) if n_files else None
+
+    def _watch(self) -> None:
+        start = last_progress = time.monotonic()
+        # Files staged by an earlier attempt are no progress of this one
+        last_activity = self._activity()
+        while not self._done.wait(self.poll_seconds):
+            now = time.monotonic()
+            activity = self._activity()
+            if activity is not None and activity != last_activity:
+                last_activity, last_progress = activity, now
+            if now - start > self.total_seconds:
+                return self._expire(f"task exceeded {self.total_seconds:.0f}s")
+            if now - last_progress > self.stall_seconds:
+                return self._expire(f"download stalled for {self.stall_seconds:.0f}s")
+
+    def _expire(self, reason: str) -> None:
+        self.expired = reason
+        killed = kill_child_processes()
+        self.logger.error("Watchdog timeout: %s. Killed child processes: %s", reason, killed or "none")
+        record_failure(self.task_uri, f"Timeout: {reason}", logger=self.logger)
+        self.logger.error("Exiting daemon; the task is reclaimed once this process is gone.")
+        if self.on_hung is not None:
+            self.on_hung()
+        os._exit(1)
+
+
+def archive_aliases(record: dict) -> list:
+    # The URIs of the source of the tags and of the queued URL find the record too
+    aliases = [get_tags_uri(record.get("tags") or {})]
+    url = (record.get("settings") or {}).get("urls")
+    platform = get_url_platform(url) if isinstance(url, str) else None
+    if platform is not None:
+        try:
+            aliases.append(platform.url2uri(url))
+        except ValueError:
+            pass
+    return [a for a in aliases if a and a != "manual"]
+
+
+def download_track(track_uri: str, logger: logging.Logger | None = None, mover: "Mover | None" = None,
+                   on_published=None) -> None:
+    """
+    This handles downloading audio from YouTube and setting the right tags.
+    The audio_format setting determines the container: mp3 is transcoded,
+    m4a and opus are remuxed from the source stream without re-encoding.
+
+    All work on the audio file happens in the task's staging directory. The
+    finished file is then published to MUSIC_DIR in one copy and rename,
+    by the mover when given, so MUSIC_DIR only ever holds complete files.
+    The index item is cleared once the file is published.
 
     :param track_uri:
     :param logger:
+    :param mover:           Background mover that publishes the audio file
+    :param on_published:    Called once the task is concluded, or failed to publish
     :return: Does not return anything
     """
     logger = logger or logging.getLogger(__name__)
@@ -68,11 +386,13 @@ def download_track(track_uri: str, logger: logging.Logger | None = None) -> None
     do_overwrite = settings["do_overwrite"]
     ps = settings["print_space"]
     preferred_quality = settings["quality"]
+    audio_format = settings.get("audio_format", "mp3").lower()
 
     # Get path components
     artist_p, album_p, track_p = get_path_components(mp3_tags)
 
     file_exists = False
+    staged_audio = None
     if avoid_duplicates and any(track_exists(artist_p, track_p)):
         logger.info("Skipped: FileExists")
         file_exists = True
@@ -80,18 +400,13 @@ def download_track(track_uri: str, logger: logging.Logger | None = None) -> None
         # Define paths
         album_dir = clip_path_length(music_dir / artist_p / album_p)
         tr_prefix = None if mp3_tags.get("track_num") is None else f'{mp3_tags["track_num"]} - '
-        mp3_fname = album_dir / f"{tr_prefix}{track_p}.mp3"
-        os.makedirs(album_dir, exist_ok=True)
-
+        mp3_fname = album_dir / f"{tr_prefix}{track_p}.{audio_format}"
         art_fname = album_dir.parent / "artist.jpg"
-        art_exists = art_fname.is_file()
-
         cov_fname = album_dir / "folder.jpg"
-        cov_exists = cov_fname.is_file()
 
         # Log storage locations
         logger.info('%s "%s"', "Album dir".ljust(ps), album_dir)
-        logger.info('%s "%s"', "MP3 Audio filename".ljust(ps), mp3_fname)
+        logger.info('%s "%s"', "Audio filename".ljust(ps), mp3_fname)
         logger.info('%s "%s"', "Artist filename   ".ljust(ps), art_fname)
         logger.info('%s "%s"', "Cover filename    ".ljust(ps), cov_fname)
 
@@ -109,77 +424,291 @@ def download_track(track_uri: str, logger: logging.Logger | None = None) -> None
         else:
             cover_url = mp3_tags.pop("cover")
 
-        # Download artist image
-        if artist_url is None:
-            logger.warning("ValueError: No artist image URL set.")
-        elif art_exists and not do_overwrite:
-            logger.info('%s "%s"', "FileExistsWarning:".ljust(ps), art_fname)
-        else:
-            if art_exists:
-                logger.info('%s "%s"', "File Overwritten:".ljust(ps), art_fname)
-            call_with_backoff(
-                download_cover_img,
-                art_fname,
-                artist_url,
-                logger=logger,
-                print_space=ps,
-            )
-        
-        # Download cover image
-        if cover_url is None:
-            logger.warning("ValueError: No cover URL set.")
-        elif cov_exists and not do_overwrite:
-            logger.info('%s "%s"', "FileExistsWarning:".ljust(ps), cov_fname)
-        else:
-            if cov_exists:
-                logger.info('%s "%s"', "File Overwritten:".ljust(ps), cov_fname)
-            # Cover downloads can also be throttled (HTTP 429). Respect Retry-After when present.
-            call_with_backoff(
-                download_cover_img,
-                cov_fname,
-                cover_url,
-                logger=logger,
-                print_space=ps,
-            )
+        # Stages completed by an earlier, interrupted attempt are skipped
+        staging = TaskStaging(track_uri)
+
+        # Only one daemon at a time sets up the album directory and its assets
+        with album_setup(album_key(mp3_tags), logger=logger):
+            set_up_album(album_dir, art_fname, cov_fname, artist_url, cover_url, staging,
+                         do_overwrite, logger=logger, print_space=ps)
 
         # Specify downloading method
         download_method = get_url_platform(track_uri)
         track_url = download_method.uri2url(track_uri)
 
-        # Check if file already exists and if it should be overwritten
-        if do_overwrite and os.path.isfile(mp3_fname):
-            logger.info('%s "%s"', "File Overwritten:".ljust(ps), mp3_fname)
-            os.remove(mp3_fname)
+        # The audio file is produced and tagged in the staging directory
+        staged_audio = staging.path / f"audio.{audio_format}"
+        if staging.is_done("audio") and os.path.isfile(staged_audio):
+            logger.info('%s "%s"', "Resumed: audio".ljust(ps), staged_audio)
+        else:
+            # Check if file already exists and if it should be overwritten
+            if do_overwrite and os.path.isfile(mp3_fname):
+                logger.info('%s "%s"', "File Overwritten:".ljust(ps), mp3_fname)
+
+            # Download the source audio, unless an earlier attempt completed it.
+            # Partial downloads continue from the last received byte.
+            source = staging.get("source")
+            produced = find_produced(track_uri, audio_format, preferred_quality)
+            if source is not None and os.path.isfile(source["path"]):
+                logger.info('%s "%s"', "Resumed: source audio".ljust(ps), source["path"])
+            elif produced is not None:
+                # The audio was produced before for another placement. It is
+                # remuxed (not re-encoded) with the tags of this track.
+                logger.info('%s "%s"', "Reusing audio".ljust(ps), produced)
+                source = {"path": str(produced), "acodec": copyable_codecs[audio_format][0],
+                          "bytes": 0, "track_uri": track_uri}
+                staging.complete("source", source)
+            else:
+                source = download_source(track_uri, download_info, download_method, audio_format,
+                                         preferred_quality, logger=logger, print_space=ps)
+                logger.info('%s %s', "Bytes downloaded".ljust(ps), source["bytes"])
+                staging.complete("source", source)
+
+            # The audio may come from an alternate candidate
+            if source.get("track_uri"):
+                track_url = download_method.uri2url(source["track_uri"])
+
+            # Tags, and the cover when embed_cover is set, are written in the
+            # same pass as the audio, so the file is never rewritten
+            cover_path = None
+            if settings.get("embed_cover"):
+                cover_path = next((p for p in (staging.path / cov_fname.name, cov_fname) if p.is_file()), None)
+            metadata_path = None
+            if audio_format == "mp3":
+                write_id3_header(mp3_tags, staged_audio, track_url, cover_path, logger=logger)
+            else:
+                metadata_path = staging.path / "metadata.txt"
+                metadata_path.write_text(ffmetadata(mp3_tags, audio_format, track_url, cover_path), encoding="utf-8")
+
+            # Convert the source stream to the requested audio file
+            try:
+                n_bytes = transcode(source["path"], staged_audio, audio_format, preferred_quality,
+                                    source_codec=source["acodec"], logger=logger, metadata=metadata_path,
+                                    cover=cover_path if audio_format == "m4a" else None,
+                                    append=audio_format == "mp3")
+                logger.info('%s %s', "Bytes written".ljust(ps), n_bytes)
+                staging.complete("audio")
+            except subprocess.CalledProcessError as e:
+                stderr = e.stderr.decode(errors="replace").strip()
+                logger.error("FFmpeg conversion failed: %s", stderr)
+                raise DownloadFailed(f"FFmpeg conversion failed: {stderr}") from e
+
+        file_exists = os.path.isfile(staged_audio)
+
+    # Conclude
+    if not file_exists:
+        logger.info("download_track %s", conclusion)
+        raise DownloadFailed("No audio file was produced")
+
+    def conclude() -> None:
+        staging = TaskStaging(track_uri)
+        source = staging.get("source")
+        if staged_audio is not None:
+            record_produced((source or {}).get("track_uri") or track_uri, mp3_fname, audio_format,
+                            preferred_quality)
+        if source is not None and source.get("track_uri", track_uri) != track_uri:
+            # An alternate candidate was downloaded to its own staging directory
+            TaskStaging(source["track_uri"]).clear()
+        staging.clear()
+        # Archive the record before clearing it, to restore it without matching
+        record = index.read(track_uri)
+        if record is not None:
+            archive.append(track_uri, record, aliases=archive_aliases(record), logger=logger)
+        index.write(track_uri, overwrite=True)
+        index.record_completion()
+        logger.info("Index item cleared to None.")
+        logger.info("download_track %s", "finished successfully.")
+        if on_published is not None:
+            on_published()
+
+    def failed(error: BaseException) -> None:
+        logger.error("Publishing the audio file failed: %s", error)
+        record_failure(track_uri, error, logger=logger)
+        if on_published is not None:
+            on_published()
+
+    if staged_audio is None:
+        conclude()
+    elif mover is None:
+        publish(staged_audio, mp3_fname)
+        logger.info('%s "%s"', "Published".ljust(ps), mp3_fname)
+        conclude()
+    else:
+        mover.submit(staged_audio, mp3_fname, on_done=conclude, on_error=failed, logger=logger)
+
+
+def set_up_album(album_dir: Path, art_fname: Path, cov_fname: Path, artist_url: str | None,
+                 cover_url: str | None, staging: TaskStaging, do_overwrite: bool,
+                 logger: logging.Logger | None = None, print_space: int = 24) -> None:
+    """
+    Creates the album directory and downloads the artist image and cover that
+    all tracks of the album share. Assets that exist are kept, unless
+    do_overwrite is set.
+
+    :param album_dir:       Directory of the album
+    :param art_fname:       Path of the artist image
+    :param cov_fname:       Path of the cover image
+    :param artist_url:      URL of the artist image
+    :param cover_url:       URL of the cover image
+    :param staging:         Staging area of the task
+    :param do_overwrite:    Whether to overwrite existing assets
+    :param logger:          logging object
+    :param print_space:     Width of the log labels
+    """
+    logger = logger or logging.getLogger(__name__)
+    ps = print_space
+    os.makedirs(album_dir, exist_ok=True)
+    # Images are downloaded to the staging directory, then published
+    staging.path.mkdir(parents=True, exist_ok=True)
+    art_exists = art_fname.is_file()
+    cov_exists = cov_fname.is_file()
+
+    # Download artist image
+    if artist_url is None:
+        logger.warning("ValueError: No artist image URL set.")
+    elif staging.is_done("artist"):
+        logger.info('%s "%s"', "Resumed: artist image".ljust(ps), art_fname)
+    elif art_exists and not do_overwrite:
+        logger.info('%s "%s"', "FileExistsWarning:".ljust(ps), art_fname)
+    else:
+        if art_exists:
+            logger.info('%s "%s"', "File Overwritten:".ljust(ps), art_fname)
+        call_with_backoff(
+            download_cover_img,
+            staging.path / art_fname.name,
+            artist_url,
+            logger=logger,
+            print_space=ps,
+        )
+        publish(staging.path / art_fname.name, art_fname)
+    staging.complete("artist")
 
-        # Download audio
-        # yt-dlp / HTTP calls may occasionally hit throttles too.
+    # Download cover image
+    if cover_url is None:
+        logger.warning("ValueError: No cover URL set.")
+    elif staging.is_done("cover"):
+        logger.info('%s "%s"', "Resumed: cover image".ljust(ps), cov_fname)
+    elif cov_exists and not do_overwrite:
+        logger.info('%s "%s"', "FileExistsWarning:".ljust(ps), cov_fname)
+    else:
+        if cov_exists:
+            logger.info('%s "%s"', "File Overwritten:".ljust(ps), cov_fname)
+        # Cover downloads can also be throttled (HTTP 429). Respect Retry-After when present.
         call_with_backoff(
-            download_method.audio_download,
-            track_url,
-            mp3_fname,
-            preferred_quality,
+            download_cover_img,
+            staging.path / cov_fname.name,
+            cover_url,
             logger=logger,
+            print_space=ps,
         )
+        publish(staging.path / cov_fname.name, cov_fname)
+    staging.complete("cover")
+
 
-        # Set file tags
-        if os.path.isfile(mp3_fname):
-            file_exists = True
-            set_file_tags(
-                mp3_tags=mp3_tags,
-                file_name=mp3_fname,
-                audio_source_url=track_url,
+def download_source(track_uri: str, download_info: dict, download_method, audio_format: str,
+                    quality: int, logger: logging.Logger | None = None, print_space: int = 24) -> dict:
+    """
+    Downloads the source audio of the matched candidate, falling through to the
+    ranked alternate candidates stored in the index item when a candidate is
+    permanently unavailable (e.g. removed or region-locked). This needs no new
+    search on any platform.
+
+    Candidates that failed permanently are stored in the index item, so that
+    they are skipped by later attempts. Transient failures are raised, so that
+    the task is retried later with the same candidate.
+
+    :param track_uri:       URI of the task
+    :param download_info:   The index item of the task
+    :param download_method: The platform module to download with
+    :param audio_format:    Target container
+    :param quality:         Target bitrate in kB/s
+    :param logger:          logging object
+    :param print_space:     spacing of log labels
+    :return:                The downloaded source, including the URI of the
+                            candidate it was downloaded from.
+    """
+    logger = logger or logging.getLogger(__name__)
+    failed = list(download_info.get("failed_candidates", []))
+    candidates = [track_uri] + [a["track_uri"] for a in download_info.get("alternates", [])]
+    candidates = [c for c in candidates if c not in failed]
+    if not candidates:
+        raise DownloadFailed("Video unavailable: all candidates failed")
+
+    for i, candidate in enumerate(candidates):
+        if i:
+            logger.info('%s "%s"', "Falling back to:".ljust(print_space), candidate)
+        source = raw_cache.fetch(candidate, audio_format, quality, TaskStaging(candidate).path, logger=logger)
+        if source is not None:
+            source["track_uri"] = candidate
+            return source
+        try:
+            # yt-dlp / HTTP calls may occasionally hit throttles too.
+            source = call_with_backoff(
+                download_method.source_download,
+                download_method.uri2url(candidate),
+                audio_format,
+                quality,
                 logger=logger,
             )
+        except DownloadFailed as e:
+            if classify_error(e) == "transient" or candidate == candidates[-1]:
+                raise
+            failed.append(candidate)
+            index.update(track_uri, failed_candidates=failed)
+            continue
+        raw_cache.store(candidate, source, audio_format, quality, logger=logger)
+        source["track_uri"] = candidate
+        return source
 
-    # Conclude
-    if file_exists:
-        index.write(track_uri, overwrite=True)
-        logger.info("Index item cleared to None.")
-        conclusion = "finished successfully."
-    logger.info("download_track %s", conclusion)
 
+def record_failure(task_uri: str, error: BaseException | str, logger: logging.Logger | None = None) -> None:
+    """
+    Stores the outcome of a failed attempt with the task in the index.
+
+    Transient failures are given a next attempt time with exponential backoff
+    (with jitter). Permanent failures, and transient failures that exhausted
+    RETRY_MAX_ATTEMPTS, are parked: workers no longer claim them.
 
-def syscall(verbose: bool = False, sleep_seconds: int = 10) -> None:
+    :param task_uri:    URI of the task that failed
+    :param error:       The exception or its message
+    :param logger:      logging object
+    """
+    logger = logger or logging.getLogger(__name__)
+    record = index.read(task_uri) if index.has_uri(task_uri) else None
+    if record is None:
+        return
+    attempts = (record.get("outcome") or {}).get("attempts", 0) + 1
+    error_class = classify_error(error)
+    if error_class == "transient" and attempts >= retry_max_attempts:
+        error_class = "permanent"
+    outcome = {
+        "error": error_class,
+        "reason": str(error),
+        "attempts": attempts,
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "next_attempt": None,
+    }
+    if error_class == "transient":
+        delay = min(retry_base_seconds * 2 ** (attempts - 1), retry_max_seconds)
+        outcome["next_attempt"] = time.time() + delay * random.uniform(1, 1.25)
+        logger.warning("Attempt %d failed (transient), retrying in %.0fs: %s", attempts, delay, error)
+    else:
+        logger.warning("Attempt %d failed (permanent), task parked: %s", attempts, error)
+    index.update(task_uri, outcome=outcome)
+
+
+def is_due(record: dict | None, now: float | None = None) -> bool:
+    """Whether a pending index record may be claimed: not parked, and not backing off."""
+    if record is None:
+        return False
+    outcome = record.get("outcome") or {}
+    if outcome.get("error") == "permanent":
+        return False
+    return (outcome.get("next_attempt") or 0) <= (time.time() if now is None else now)
+
+
+def syscall(verbose: bool = False, sleep_seconds: int = 10, max_daemons: int | None = None,
+            min_priority: int | None = None, supervise: bool = False, min_daemons: int | None = None) -> None:
     """Spawn a daemon process.
 
     Uses subprocess (no shell), so it's cross-platform and doesn't depend on '&' or pythonw.
@@ -188,11 +717,19 @@ def syscall(verbose: bool = False, sleep_seconds: int = 10) -> None:
     args = [
         sys.executable,
         __file__,
-        "--sleep-seconds",
+        "--sleep_seconds",
         str(sleep_seconds),
     ]
     if verbose:
         args.append("--verbose")
+    if max_daemons is not None:
+        args += ["--max_daemons", str(max_daemons)]
+    if min_priority is not None:
+        args += ["--min_priority", str(min_priority)]
+    if supervise:
+        args.append("--supervise")
+    if min_daemons is not None:
+        args += ["--min_daemons", str(min_daemons)]
 
     subprocess.Popen(
         args,
@@ -206,7 +743,8 @@ def syscall(verbose: bool = False, sleep_seconds: int = 10) -> None:
     )
 
 
-def start_daemons(max_daemons: int = 4, verbose: bool = False, sleep_seconds: int = 10) -> int:
+def start_daemons(max_daemons: int = 4, verbose: bool = False, sleep_seconds: int = 10,
+                  autoscale: bool = False, min_daemons: int = 1) -> int:
     """
     .. py:function:: start_daemons(max_daemons=4, verbose=False)
 
@@ -218,6 +756,9 @@ def start_daemons(max_daemons: int = 4, verbose: bool = False, sleep_seconds: in
     :param int max_daemons: The number up until new daemons will be started.
     :param bool verbose: Whether to run the daemon process in the foreground
     :param int sleep_seconds: Seconds to sleep between downloads (per daemon)
+    :param bool autoscale: Whether a supervisor process scales the number of daemons
+        between min_daemons and max_daemons
+    :param int min_daemons: The number of daemons the supervisor keeps at least
 
     :return: Number of daemon processes started
     :rtype: int
@@ -227,15 +768,30 @@ def start_daemons(max_daemons: int = 4, verbose: bool = False, sleep_seconds: in
         return 1
 
     n_started = 0
-    # Only try to start daemons when there are tasks to do
-    for _i, _ in zip(range(max_daemons), get_tasks()):
-        n_daemons = len(glob(daemon_dir.format("[0-9]")))
-        if n_daemons < max_daemons:
+    if autoscale:
+        # The supervisor starts and stops the daemons
+        if desired_daemons() is None and any(get_tasks()):
             n_started += 1
-            # syscall already spawns a background process correctly; no need for multiprocessing wrapper
-            syscall(verbose=False, sleep_seconds=sleep_seconds)
-        else:
-            break
+            syscall(verbose=False, sleep_seconds=sleep_seconds, max_daemons=max_daemons,
+                    supervise=True, min_daemons=min_daemons)
+    else:
+        # Only try to start daemons when there are tasks to do
+        for _i, _ in zip(range(max_daemons), get_tasks()):
+            n_daemons = len(glob(daemon_dir.format("[0-9]")))
+            if n_daemons < max_daemons:
+                n_started += 1
+                # syscall already spawns a background process correctly; no need for multiprocessing wrapper
+                syscall(verbose=False, sleep_seconds=sleep_seconds, max_daemons=max_daemons)
+            else:
+                break
+
+    # When all daemons are busy with a batch, an interactive request gets an
+    # extra daemon that only claims interactive tasks, so it starts right away.
+    # One such daemon serves all interactive requests.
+    if not n_started and not interactive_daemon_running() \
+            and any(get_tasks(min_priority=index.interactive_priority)):
+        n_started += 1
+        syscall(verbose=False, sleep_seconds=0, max_daemons=-1, min_priority=index.interactive_priority)
     return n_started
 
 
@@ -244,11 +800,219 @@ def uri2tmp(n, uri: str | Path) -> str:
     return daemon_dir.format(f"{n}_{str(uri)}")
 
 
-def get_tasks() -> list:
-    """Return list of unprocessed URIs that are not currently busy (no tmp marker present)."""
-    uris = index.to_do()
-    uris = [u for u in uris if not any(glob(uri2tmp("*", u)))]  # busy
-    return uris
+def task_claim_path(uri: str | Path) -> Path:
+    """Path of the TMP marker by which one daemon at a time claims the task of the URI."""
+    return uri2tmp("task", uri)
+
+
+def is_busy(uri: str) -> bool:
+    """Whether a live daemon holds a tmp marker for the URI.
+
+    Markers left behind by daemons that died do not count, so that their task
+    can be reclaimed and resumed. claim_lock takes such a claim over.
+    """
+    return any(not LockFile(marker, claim=False).is_orphaned() for marker in glob(uri2tmp("*", uri)))
+
+
+def get_tasks(min_priority: int | None = None, prefer_album: str | None = None) -> list:
+    """Return list of unprocessed URIs that are due and not currently busy (no live tmp marker present).
+
+    URIs are listed in the order they should be claimed: by priority, then
+    tracks of prefer_album, then by the number of tasks of the same batch
+    that are in progress, so that concurrent batches share the daemons
+    fairly, then first in, first out. Tracks of albums that another daemon
+    is setting up are left out until the album directory and assets exist.
+
+    :param min_priority: Only list tasks with at least this priority.
+    :param prefer_album: Album key of the album the daemon worked on last.
+    """
+    now = time.time()
+    pending = []
+    in_progress: dict[str | None, int] = {}
+    in_setup: dict[str, bool] = {}
+    for uri in index.to_do():
+        record = index.read(uri)
+        if record is None:
+            continue
+        queue = index.queue_info(record)
+        if is_busy(uri):
+            in_progress[queue["batch"]] = in_progress.get(queue["batch"], 0) + 1
+        elif is_due(record, now) and (min_priority is None or queue["priority"] >= min_priority):
+            album = album_key(record["tags"])
+            if album not in in_setup:
+                in_setup[album] = album_in_setup(album)
+            if not in_setup[album]:
+                pending.append((uri, album, queue))
+    pending.sort(key=lambda p: (-p[2]["priority"], p[1] != prefer_album,
+                                in_progress.get(p[2]["batch"], 0), p[2]["enqueued"]))
+    return [uri for uri, _, _ in pending]
+
+
+def running_daemons() -> list[int]:
+    """Return the slot numbers of the daemons that are running, in ascending order."""
+    slots = []
+    for marker in glob(daemon_dir.format("[0-9]*")):
+        n = marker.name[len("daemon-"):-len(".tmp")]
+        if n.isdigit() and not LockFile(marker, claim=False).is_orphaned():
+            slots.append(int(n))
+    return sorted(slots)
+
+
+def interactive_daemon_running() -> bool:
+    """Whether the extra daemon that serves interactive requests is running."""
+    owner = lock_owner(interactive_daemon_path)
+    return owner is not None and pid_is_alive(owner)
+
+
+def desired_daemons() -> int | None:
+    """Return the number of daemons the supervisor wants to run, or None when no supervisor runs."""
+    owner = lock_owner(supervisor_path)
+    if owner is None or not pid_is_alive(owner) or not desired_daemons_path.is_file():
+        return None
+    return (json_in(desired_daemons_path) or {}).get("desired")
+
+
+def recent_throttles(since: float) -> int:
+    """Return the number of pending tasks that failed on HTTP 429 or a bot check since the given time."""
+    n_throttled = 0
+    for uri in index.to_do():
+        outcome = (index.read(uri) or {}).get("outcome") or {}
+        if not outcome.get("time") or not is_throttled(outcome.get("reason", "")):
+            continue
+        if datetime.fromisoformat(outcome["time"]).timestamp() >= since:
+            n_throttled += 1
+    return n_throttled
+
+
+def load_per_core() -> float | None:
+    """Return the 1-minute load average per CPU core, or None where it is not available."""
+    if not hasattr(os, "getloadavg"):
+        return None
+    return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+
+class Autoscaler:
+    """Decides how many download daemons should run.
+
+    Daemons are added one at a time while tasks are waiting, as long as each
+    addition raised the throughput; an addition that did not is reverted and
+    caps the number for a while, as the link is saturated. An addition made
+    while no task completed is not judged by its gain. The number is
+    halved on signs of throttling (HTTP 429, bot checks) and lowered while
+    the CPU is overloaded. It always stays between floor and ceiling.
+    """
+
+    def __init__(self, floor: int, ceiling: int, load_limit: float = autoscale_load_limit,
+                 settle_seconds: float = 2 * autoscale_interval, logger: logging.Logger | None = None):
+        self.floor = max(0, floor)
+        self.ceiling = max(self.floor, ceiling)
+        self.load_limit = load_limit
+        self.settle_seconds = settle_seconds
+        self.logger = logger or logging.getLogger(__name__)
+        self.desired = self.floor
+        self.changed_at = 0.0
+        # Throughput before the last addition, until its effect is known
+        self.grown_from: float | None = None
+        self.cap = self.ceiling
+        self.capped_at = 0.0
+
+    def decide(self, queue_depth: int, running: int, throughput: float, load: float | None,
+               throttled: int, now: float | None = None) -> int:
+        """
+        :param queue_depth: Number of tasks that are due and not claimed
+        :param running:     Number of daemons that are running
+        :param throughput:  Tasks completed per minute over the settle period
+        :param load:        Load average per core (None if unknown)
+        :param throttled:   Number of throttled requests since the last decision
+        :param now:         Time of the decision
+        :return:            The number of daemons that should run
+        """
+        now = time.time() if now is None else now
+        if self.cap < self.ceiling and now - self.capped_at > 10 * self.settle_seconds:
+            self.cap = self.ceiling
+        desired, reason = self.desired, "hold"
+        if throttled:
+            desired, reason = self.desired // 2, f"{throttled} throttled request(s)"
+            self.cap, self.capped_at = max(desired, self.floor), now
+        elif load is not None and load > self.load_limit:
+            desired, reason = self.desired - 1, f"CPU load {load:.2f} per core"
+        elif now - self.changed_at < self.settle_seconds:
+            reason = "settling"
+        # Without completions before the last addition, e.g. while long tracks
+        # download, there is no baseline to measure its gain against
+        elif self.grown_from and throughput <= self.grown_from * 1.05:
+            desired, reason = self.desired - 1, "no throughput gain from the last daemon"
+            self.cap, self.capped_at = max(desired, self.floor), now
+        elif queue_depth and self.desired < self.cap:
+            desired, reason = self.desired + 1, "tasks waiting"
+        elif queue_depth:
+            reason = "at ceiling" if self.cap == self.ceiling else "link saturated"
+        desired = min(max(desired, self.floor), self.ceiling)
+
+        if desired != self.desired:
+            self.grown_from = throughput if desired > self.desired else None
+            self.changed_at = now
+        elif reason != "settling":
+            self.grown_from = None
+        self.logger.info(
+            "Autoscale %d -> %d (%s): queue %d, running %d, throughput %.1f/min, load %s, throttled %d",
+            self.desired, desired, reason, queue_depth, running, throughput,
+            "n/a" if load is None else f"{load:.2f}", throttled,
+        )
+        self.desired = desired
+        return desired
+
+
+def run_supervisor(min_daemons: int = 1, max_daemons: int = 4, sleep_seconds: int = 10,
+              interval: float = autoscale_interval, logger: logging.Logger | None = None) -> None:
+    """
+    Runs the autoscaling supervisor until the queue is empty and all daemons finished.
+
+    Every interval, the Autoscaler decides the number of daemons from the queue
+    depth, the throughput, the CPU load and recent throttling. The supervisor
+    starts daemons up to that number and publishes it, so that daemons above
+    it exit after their current task.
+
+    :param min_daemons:     Floor of the number of daemons
+    :param max_daemons:     Ceiling of the number of daemons
+    :param sleep_seconds:   Seconds daemons sleep between downloads
+    :param interval:        Seconds between scaling decisions
+    :param logger:          logging object
+    """
+    logger = logger or logging.getLogger(__name__)
+    supervisor_path.parent.mkdir(parents=True, exist_ok=True)
+    if not claim_lock(supervisor_path):
+        logger.info("Supervisor not started: another supervisor is running.")
+        return
+
+    def release() -> None:
+        for path in (desired_daemons_path, supervisor_path):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    atexit.register(release)
+    scaler = Autoscaler(min_daemons, max_daemons, settle_seconds=2 * interval, logger=logger)
+    last_decision = time.time()
+    while True:
+        now = time.time()
+        queue_depth = len(get_tasks())
+        running = running_daemons()
+        if not queue_depth and not running:
+            logger.info("Supervisor finished: No unprocessed URIs found.")
+            break
+
+        throughput = index.completed_since(now - scaler.settle_seconds) * 60 / scaler.settle_seconds
+        desired = scaler.decide(queue_depth, len(running), throughput, load_per_core(),
+                                recent_throttles(last_decision), now=now)
+        last_decision = now
+        json_out({"desired": desired}, desired_daemons_path)
+
+        for _ in range(min(desired - len(running), queue_depth)):
+            syscall(verbose=False, sleep_seconds=sleep_seconds, max_daemons=max_daemons)
+        time.sleep(interval)
+    release()
 
 
 @click.command()
@@ -263,16 +1027,45 @@ def get_tasks() -> list:
     type=int,
     help="Seconds to sleep between downloads to avoid rate limiting",
 )
-def daemon_job(max_daemons: int = 4, verbose: bool = False, verbose_continuous: bool = False, sleep_seconds: int = 10):
+@click.option("-n", "--min_priority", default=None, type=int, help="Only download tasks with at least this priority")
+@click.option("-s", "--supervise", is_flag=True, default=False,
+              help="Run the supervisor that scales the number of DAEMONs")
+@click.option("-m", "--min_daemons", default=1, type=int, help="Number of DAEMONs the supervisor keeps at least")
+def daemon_job(max_daemons: int = 4, verbose: bool = False, verbose_continuous: bool = False, sleep_seconds: int = 10,
+               min_priority: int | None = None, supervise: bool = False, min_daemons: int = 1):
     # Local import to avoid breaking callers if logging_setup import paths differ in other contexts
     from logging_setup import configure_logger
 
+    if supervise:
+        supervisor_logger = configure_logger(
+            name="web2mp3.supervisor",
+            log_file=log_dir.format("supervisor", "log"),
+            console=bool(verbose),
+        )
+        run_supervisor(min_daemons, max_daemons, sleep_seconds, logger=supervisor_logger)
+        return
+
     daemon_logger = configure_logger(
         name="web2mp3.daemon",
         log_file=log_dir.format(f"daemon-{os.getpid()}", "log"),
         console=bool(verbose),
     )
 
+    # The extra daemon for interactive requests runs once, see start_daemons
+    interactive = max_daemons == -1 and min_priority is not None
+    if interactive:
+        interactive_daemon_path.parent.mkdir(parents=True, exist_ok=True)
+        if not claim_lock(interactive_daemon_path):
+            daemon_logger.info("No Daemon initiated, a Daemon for interactive requests is running.")
+            return
+        atexit.register(interactive_daemon_path.unlink, missing_ok=True)
+
+    # Free the slots of daemons that died without removing their lock
+    for marker in glob(daemon_dir.format("[0-9]*")):
+        lock = LockFile(marker, claim=False)
+        if "_" not in marker.name and lock.is_orphaned():
+            lock.rm()
+
     # List daemons that are not running
     daemon_ns = [i for i in range(max_daemons) if not daemon_dir.format(i).is_file()]
 
@@ -301,18 +1094,40 @@ def daemon_job(max_daemons: int = 4, verbose: bool = False, verbose_continuous:
     daemon_tmp = LockFile(daemon_name)
     atexit.register(daemon_tmp.rm)
 
-    tried: list[str] = []
+    def hand_over() -> None:
+        # Hand the slot over to a fresh daemon when this one has to exit
+        daemon_tmp.rm()
+        if interactive:
+            interactive_daemon_path.unlink(missing_ok=True)
+        syscall(verbose=False, sleep_seconds=sleep_seconds, max_daemons=max_daemons, min_priority=min_priority)
+
+    # Finished files are published in the background while the next task runs
+    mover = Mover(logger=daemon_logger)
+
+    # The daemon stays with an album, as its directory and assets are set up
+    last_album = None
     while True:
-        uris = get_tasks()
-        uris = [u for u in uris if u not in tried]  # max tries per process lifetime
+        # Daemons above the number the supervisor wants exit between tasks
+        desired = desired_daemons()
+        if desired is not None and min_priority is None and daemon_n in running_daemons()[desired:]:
+            daemon_logger.info("daemon_job finished: Scaled down to %d DAEMONs.", desired)
+            break
+
+        # Failed tasks are not due until their backoff expired, or are parked
+        uris = get_tasks(min_priority, prefer_album=last_album)
 
         if len(uris) > 0:
             task = uris[0]
-            tried.append(task)
-
-            task_tmp = LockFile(uri2tmp(daemon_n, task))
+            # Claiming is atomic, as another daemon may have listed the same task
+            task_path = task_claim_path(task)
+            if not claim_lock(task_path):
+                continue
+            task_tmp = LockFile(task_path, claim=False)
             atexit.register(task_tmp.rm)
 
+            record = index.read(task)
+            last_album = album_key(record["tags"]) if record else None
+
             logger_path = log_dir.format(task, "txt")
             task_logger = configure_logger(
                 name=f"web2mp3.download.{daemon_n}",
@@ -320,8 +1135,24 @@ def daemon_job(max_daemons: int = 4, verbose: bool = False, verbose_continuous:
                 console=bool(verbose),
             )
 
-            download_track(task, logger=task_logger)
-            task_tmp.rm()
+            watchdog = Watchdog(
+                task,
+                stall_seconds=download_stall_timeout,
+                total_seconds=download_task_timeout,
+                logger=task_logger,
+                on_hung=hand_over,
+                watch_uris=[a.get("track_uri") for a in (record or {}).get("alternates") or ()],
+            )
+            try:
+                with watchdog:
+                    # The task stays claimed until its audio file is published
+                    download_track(task, logger=task_logger, mover=mover, on_published=task_tmp.rm)
+            except Exception as e:
+                # On a watchdog timeout the daemon exits and keeps the claim
+                if watchdog.expired is None:
+                    task_logger.exception("download_track raised an error")
+                    record_failure(task, e, logger=task_logger)
+                    task_tmp.rm()
 
             if sleep_seconds > 0:
                 task_logger.info("Sleeping %d seconds to avoid YouTube rate limiting", sleep_seconds)
@@ -332,6 +1163,7 @@ def daemon_job(max_daemons: int = 4, verbose: bool = False, verbose_continuous:
 
         if verbose and not verbose_continuous:
             break
+    mover.close()
 
 
 if __name__ == "__main__":
@@ -1,8 +1,52 @@
-from initialize import index_path, Path
+from initialize import index_path, profiles_path, Path
 from utils import input_is
-from utils import json_out, json_in
+from utils import json_in, pid_is_alive, BloomFilter
 from typing import List
+import atexit
+import hashlib
 import json
+import os
+import struct
+import time
+
+try:
+    # orjson is optional: a faster codec for the same (minified) JSON
+    import orjson
+except ImportError:
+    orjson = None
+
+# Settings that differ per track are stored in the record itself, all other
+# settings in a shared profile.
+track_settings = ('urls', 'priority', 'batch')
+
+# Settings profiles that were read or written by this process, by ID
+_profiles: dict = {}
+
+# Journals of the group commits of each process, see write_many
+journal_path = index_path.parent / 'index-{}.journal'
+
+# Downloads that were completed, one log per day with a timestamp per line,
+# see record_completion; logs older than the previous day are removed
+completions_path = index_path.parent / 'completed-{}.log'
+
+# Number of index items main.py commits at once when queueing a playlist or album
+group_commit_size = 50
+
+# Bloom filter over the names of all index items, persisted between runs with
+# the modification time of the index directory it reflects, see has_uri. When
+# other processes changed the index, the filter is rebuilt at most once per
+# bloom_refresh_seconds; meanwhile its misses are checked on the file system.
+bloom_path = index_path.parent / 'index.bloom'
+bloom_refresh_seconds = 30
+_bloom_stamp = struct.Struct('>q')
+_bloom: BloomFilter | None = None
+_bloom_mtime: int | None = None
+_bloom_built = 0.0
+
+# Download priorities: higher goes first. Tracks that were requested one by one
+# precede tracks that were unpacked from a playlist or album.
+interactive_priority = 10
+batch_priority = 0
 
 
 def uri2path(uri: str | Path) -> Path:
@@ -24,24 +68,217 @@ def uri2path(uri: str | Path) -> Path:
 
 def has_uri(uri: str | Path) -> bool:
     """
-    Checks if the file corresponding to the URI exists in the index.
+    Checks if the file corresponding to the URI exists in the index. URIs that
+    the Bloom filter does not know are not in the index, as long as no other
+    process changed the index since the filter was synced; this costs a stat
+    of the index directory instead of a lookup of the item.
 
     :param uri:     A URI string or Path object representing the index item.
     :return:        True if the file exists, False otherwise.
     """
-    return uri2path(uri).is_file()
+    path = uri2path(uri)
+    if path.parent == index_path and path.name not in load_bloom():
+        if _index_mtime() == _bloom_mtime:
+            return False
+        # Another process changed the index since the filter was synced
+        if time.monotonic() - _bloom_built > bloom_refresh_seconds:
+            rebuild_bloom()
+            if path.name not in _bloom and _index_mtime() == _bloom_mtime:
+                return False
+    return path.is_file()
+
+
+def _index_mtime() -> int:
+    return index_path.stat().st_mtime_ns
+
+
+def load_bloom() -> BloomFilter:
+    """
+    Returns the Bloom filter over the index. The persisted filter is used when
+    the index directory did not change since it was saved; otherwise it has
+    drifted and is rebuilt from the index.
+
+    :return:    The Bloom filter.
+    """
+    global _bloom, _bloom_mtime, _bloom_built
+    if _bloom is None:
+        try:
+            data = bloom_path.read_bytes()
+            mtime, = _bloom_stamp.unpack_from(data)
+            if mtime == _index_mtime():
+                _bloom = BloomFilter.from_bytes(data[_bloom_stamp.size:])
+                _bloom_mtime = mtime
+                _bloom_built = time.monotonic()
+        except (FileNotFoundError, struct.error):
+            pass
+    if _bloom is None:
+        rebuild_bloom()
+    return _bloom
+
+
+def rebuild_bloom() -> None:
+    """
+    Builds the Bloom filter from the items in the index and persists it.
+
+    :return:    None.
+    """
+    global _bloom, _bloom_mtime, _bloom_built
+    _bloom_mtime = _index_mtime()
+    _bloom_built = time.monotonic()
+    names = [f.name for f in items()]
+    _bloom = BloomFilter(max(2 * len(names), 10000))
+    for name in names:
+        _bloom.add(name)
+    save_bloom()
+
+
+def save_bloom() -> None:
+    """
+    Persists the Bloom filter, unless another process changed the index since
+    this process last did; the filter is then rebuilt by the next run.
+
+    :return:    None.
+    """
+    if _bloom is None:
+        return
+    if _index_mtime() != _bloom_mtime:
+        try:
+            bloom_path.unlink()
+        except FileNotFoundError:
+            pass
+        return
+    _replace(_bloom_stamp.pack(_bloom_mtime) + _bloom.to_bytes(), bloom_path)
+
+
+def _remember(name: str, mtime: int | None) -> None:
+    # Adds an item this process wrote to the Bloom filter. The filter is only
+    # in sync after the write if it was in sync before, at the given mtime.
+    global _bloom, _bloom_mtime
+    if _bloom is None:
+        return
+    if _bloom.count >= _bloom.capacity:
+        # The filter is full; it is rebuilt larger when it is needed again
+        _bloom = None
+        return
+    _bloom.add(name)
+    if mtime == _bloom_mtime:
+        _bloom_mtime = _index_mtime()
+
+
+atexit.register(save_bloom)
+
+
+def dumps(obj) -> bytes:
+    """
+    Encodes an object as minified JSON, with orjson when it is installed.
+
+    :param obj:     A JSON serializable object.
+    :return:        The encoded object.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(obj, separators=(',', ':'), sort_keys=True, ensure_ascii=False).encode('utf-8')
+
+
+def loads(data: bytes):
+    """
+    Decodes JSON, with orjson when it is installed.
+
+    :param data:    Encoded JSON; minified or pretty-printed.
+    :return:        The decoded object.
+    """
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def _replace(data: bytes, path: Path, fsync: bool = False) -> None:
+    # Writes to a temporary file first, so that readers never see a partial file.
+    # With fsync, the content is on disk before it is renamed into place; the
+    # rename itself is durable once the directory is synced, see _fsync_dir.
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _fsync_dir(path: Path) -> None:
+    # Flushes the entries of a directory, e.g. renames into it, to disk.
+    # Directories cannot be opened, and so not flushed, on Windows.
+    if os.name == 'nt':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _load(path: Path) -> dict:
+    # Reads a stored record as is, i.e. referring to its settings profile
+    with open(path, 'rb') as f:
+        data = f.read()
+    try:
+        return loads(data)
+    except ValueError:
+        # Records are written atomically, so only records that were written
+        # before that can be damaged; fall back on the recovery of those.
+        return json_in(path)
+
+
+def write_profile(settings: dict) -> str:
+    """
+    Stores the settings that are shared between tracks as a profile, named
+    after the hash of its content, so that identical settings are stored once.
+
+    :param settings:    Settings without the per-track settings.
+    :return:            The ID of the profile.
+    """
+    data = dumps(settings)
+    profile_id = hashlib.sha1(data).hexdigest()[:16]
+    if profile_id not in _profiles:
+        path = profiles_path / f'{profile_id}.json'
+        if not path.is_file():
+            # Records that refer to the profile may be committed right after
+            profiles_path.mkdir(parents=True, exist_ok=True)
+            _replace(data, path, fsync=True)
+            _fsync_dir(profiles_path)
+        _profiles[profile_id] = settings
+    return profile_id
+
+
+def read_profile(profile_id: str) -> dict:
+    """
+    Reads a settings profile.
+
+    :param profile_id:  The ID of the profile.
+    :return:            The settings of the profile.
+    """
+    if profile_id not in _profiles:
+        with open(profiles_path / f'{profile_id}.json', 'rb') as f:
+            _profiles[profile_id] = loads(f.read())
+    return dict(_profiles[profile_id])
 
 
 def read(uri: str | Path) -> dict | None:
     """
-    Reads and returns the content of a JSON file from the index.
+    Reads and returns the content of a JSON file from the index. Records that
+    refer to a settings profile are returned with their full settings.
 
     :param uri:     A URI string or Path object representing the index item.
     :return:        A dictionary with the JSON content if the file is not empty,
                     or `None` if the file is empty.
     """
     path = uri2path(uri)
-    return None if is_empty(path) else json_in(path)
+    if is_empty(path):
+        return None
+    record = _load(path)
+    if 'profile' in record:
+        settings = read_profile(record.pop('profile'))
+        settings.update(record.pop('track_settings', None) or {})
+        record['settings'] = settings
+    return record
 
 
 def is_empty(path: Path) -> bool:
@@ -54,13 +291,84 @@ def is_empty(path: Path) -> bool:
     return path.stat().st_size == 0
 
 
+def items() -> List[Path]:
+    """
+    Lists the files of all items in the index. Hidden files, e.g. records that
+    are being written, are left out.
+
+    :return:    A list of paths of index items.
+    """
+    return [f for f in index_path.rglob("*") if not f.name.startswith('.')]
+
+
 def to_do() -> List[str]:
     """
     Retrieves a list of non-empty URIs from the index.
 
     :return:    A list of URI strings corresponding to non-empty files in the index.
     """
-    return [f.name for f in index_path.rglob("*") if not is_empty(f)]
+    replay()
+    return [f.name for f in items() if not is_empty(f)]
+
+
+def record_completion() -> None:
+    """
+    Logs that a download was completed, for the throughput of the daemons.
+    Processed items are cleared to empty files as well, but so are the markers
+    of the tags and sources that were matched, so those are not counted.
+
+    :return:    None.
+    """
+    today = time.strftime('%Y%m%d')
+    # Appends of a single line do not interleave between processes
+    fd = os.open(str(completions_path).format(today), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.write(fd, f'{time.time():.3f}\n'.encode('ascii'))
+    finally:
+        os.close(fd)
+    yesterday = time.strftime('%Y%m%d', time.localtime(time.time() - 86400))
+    for log in index_path.parent.glob(completions_path.name.format('*')):
+        if log.name < completions_path.name.format(yesterday):
+            log.unlink(missing_ok=True)
+
+
+def completed_since(since: float) -> int:
+    """
+    Counts the downloads that were completed since the given time, as logged
+    by record_completion, up to the start of the previous day.
+
+    :param since:   A UNIX timestamp.
+    :return:        The number of downloads completed since then.
+    """
+    n_completed = 0
+    for log in index_path.parent.glob(completions_path.name.format('*')):
+        try:
+            with open(log, 'rb') as f:
+                # A line that is being appended has no line end yet
+                n_completed += sum(1 for line in f if line.endswith(b'\n') and float(line) >= since)
+        except FileNotFoundError:
+            continue
+    return n_completed
+
+
+def _payload(
+        tags: dict | None = None,
+        settings: dict | None = None,
+        alternates: list | None = None,
+        priority: int = batch_priority,
+        batch: str | None = None,
+) -> bytes:
+    # Encodes an index record; processed items are empty
+    payload = {'tags': tags}
+    if settings:
+        # Settings shared with other tracks are stored once, in a profile
+        payload['profile'] = write_profile({k: v for k, v in settings.items() if k not in track_settings})
+        payload['track_settings'] = {k: settings[k] for k in track_settings if k in settings}
+    if alternates:
+        payload['alternates'] = alternates
+    if tags is not None:
+        payload['queue'] = {'priority': priority, 'batch': batch, 'enqueued': time.time()}
+    return dumps(payload) if any(payload.values()) else b''
 
 
 def write(
@@ -68,6 +376,9 @@ def write(
         tags: dict | None = None,
         settings: dict | None = None,
         overwrite: bool = True,
+        alternates: list | None = None,
+        priority: int = batch_priority,
+        batch: str | None = None,
 ) -> None:
     """
     Writes a value to a key (short URL) in the index.
@@ -76,14 +387,135 @@ def write(
     :param tags:        A dictionary of tags to associate with the key (default: `None`).
     :param settings:    A dictionary of settings to associate with the key (default: `None`).
     :param overwrite:   A boolean indicating whether to overwrite existing data (default: `True`).
+    :param alternates:  Ranked runner-up audio candidates with their scores, to
+                        fall back to when the download fails (default: `None`).
+    :param priority:    Download priority, higher goes first (default: `batch_priority`).
+    :param batch:       Identifier of the playlist or album the item was queued
+                        with, `None` for single tracks (default: `None`).
 
     :return:            None.
     """
     path = uri2path(uri)
     if not overwrite and has_uri(path):
         return
-    payload = {'tags': tags, 'settings': settings}
-    json_out(payload, path) if any(payload.values()) else open(path, 'w').close()
+    payload = _payload(tags, settings, alternates, priority, batch)
+    mtime = _index_mtime()
+    _replace(payload, path)
+    _remember(path.name, mtime)
+
+
+def write_many(items: List[dict]) -> None:
+    """
+    Writes a group of index items, e.g. those of an album or playlist, as one
+    atomic commit: after a crash either all or none of the items are written.
+
+    The group is appended to the journal of the process, which is flushed to
+    disk once; this makes the commit durable. The items are then written into
+    place without flushing each of them. The journals of processes that ended
+    are replayed, and removed, before the index is used again.
+
+    :param items:   Keyword arguments of `write` per item, including `uri`.
+
+    :return:        None.
+    """
+    replay()
+    entries, names = [], set()
+    for item in items:
+        item = dict(item)
+        name = uri2path(item.pop('uri')).name
+        # Earlier items of the group count as existing
+        if not item.pop('overwrite', True) and (has_uri(name) or name in names):
+            continue
+        names.add(name)
+        entries.append((name, _payload(**item).decode('utf-8')))
+    if not entries:
+        return
+
+    # Commit the group
+    journal = Path(str(journal_path).format(os.getpid()))
+    is_new = not journal.exists()
+    with open(journal, 'ab') as f:
+        f.write(dumps({'committed': time.time(), 'entries': entries}) + b'\n')
+        f.flush()
+        os.fsync(f.fileno())
+    if is_new:
+        _fsync_dir(journal.parent)
+    _apply(entries)
+
+
+def _apply(entries: list, committed: float | None = None) -> None:
+    # Writes journaled index items into place. A replay (given the time of the
+    # commit) leaves items alone that changed since, e.g. that were processed,
+    # and flushes the items to disk before the journal is removed.
+    for name, payload in entries:
+        path = index_path / name
+        if committed is not None:
+            try:
+                if path.stat().st_mtime >= committed:
+                    continue
+            except FileNotFoundError:
+                pass
+        mtime = _index_mtime()
+        _replace(payload.encode('utf-8'), path, fsync=committed is not None)
+        _remember(name, mtime)
+    if committed is not None:
+        _fsync_dir(index_path)
+
+
+def replay() -> None:
+    """
+    Replays the journals of `write_many` of processes that no longer exist, so
+    that items whose write did not reach the disk before a crash are written.
+
+    :return:    None.
+    """
+    for journal in index_path.parent.glob(journal_path.name.format('*')):
+        pid = journal.name[len('index-'):-len('.journal')]
+        if not pid.isdigit() or pid_is_alive(int(pid)):
+            continue
+        with open(journal, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Appended by a crash during the commit, which thus failed
+                    break
+                commit = loads(line)
+                _apply(commit['entries'], commit['committed'])
+        try:
+            journal.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def queue_info(record: dict) -> dict:
+    """
+    Returns the queue entry of a pending index record: its priority, batch and
+    enqueue time. Records written before queue entries existed default to the
+    batch priority and sort as the oldest.
+
+    :param record:  A pending index record.
+    :return:        A dictionary with `priority`, `batch` and `enqueued` keys.
+    """
+    info = {'priority': batch_priority, 'batch': None, 'enqueued': 0.0}
+    info.update(record.get('queue') or {})
+    return info
+
+
+def update(uri: str | Path, **fields) -> None:
+    """
+    Adds or replaces fields of a non-empty index item, e.g. the outcome of a
+    failed download attempt. Empty (processed) items are left untouched.
+
+    :param uri:     A URI string or Path object representing the index item.
+    :param fields:  Fields to set on the index item.
+
+    :return:        None.
+    """
+    path = uri2path(uri)
+    if not has_uri(path) or is_empty(path):
+        return
+    record = _load(path)
+    record.update(fields)
+    _replace(dumps(record), path)
 
 
 def debug() -> None:
@@ -122,15 +554,21 @@ def debug() -> None:
         print(f'Deleted index item "{uri}"')
 
     # Get statistics of the index
-    n_records = len(list(index_path.glob('*')))  # Number of URIs in the index
+    n_records = len(items())  # Number of URIs in the index
     uris_to_do = to_do()  # List of unprocessed URIs
     n_to_do = len(uris_to_do)  # Number of unprocessed items
     n_empty_records = n_records - n_to_do  # Number of processed (empty) URIs
 
+    # Failed downloads are either retried after a backoff or parked
+    errors = [(read(uri) or {}).get('outcome', {}) for uri in uris_to_do]
+    errors = [(o or {}).get('error') for o in errors]
+
     # Structure the meta information to print
     info = [
         ('number of processed records', n_empty_records),
         ('number of unprocessed records', n_to_do),
+        ('  of which awaiting retry', errors.count('transient')),
+        ('  of which parked', errors.count('permanent')),
         ('location', index_path),
     ]
 
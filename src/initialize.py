@@ -206,7 +206,18 @@ default_location = os.environ.get('LOCATION')
 # future, but currently, nothing is broken so no need to fix anything.
 daemon_dir = home_dir / '.daemons' / 'daemon-{}.tmp'
 log_dir = home_dir / '.logs' / '{}.{}'
+transcode_dir = home_dir / '.daemons' / 'transcode-{}.tmp'
+album_lock_dir = home_dir / '.daemons' / 'album-{}.tmp'
+supervisor_path = home_dir / '.daemons' / 'supervisor.tmp'
+interactive_daemon_path = home_dir / '.daemons' / 'interactive.tmp'
+desired_daemons_path = home_dir / '.daemons' / 'desired.json'
+staging_dir = Path(os.environ.get('STAGING_DIR') or home_dir / '.staging')
+cache_dir = home_dir / '.cache'
+raw_cache_dir = cache_dir / 'raw'
 index_path = home_dir / 'src' / 'index'
+profiles_path = home_dir / 'src' / 'profiles'
+archive_path = home_dir / 'src' / 'archive.gz'
+snapshots_path = home_dir / 'src' / 'snapshots'
 
 # Ensure the index path exists
 index_path.mkdir(exist_ok=True)
@@ -262,6 +273,39 @@ dotenv.load_dotenv(ENV_PATH, override=True)
 # Export as module-level variables for import by modules
 deno_bin = os.environ.get("DENO_BIN", "")
 ytdlp_remote_components = os.environ.get("YTDLP_REMOTE_COMPONENTS", "ejs:github")
+ffmpeg_bin = os.environ.get("FFMPEG_BIN") or shutil.which("ffmpeg") or "/usr/bin/ffmpeg"
+
+# Transcoding is CPU bound, so the number of concurrent FFmpeg jobs is bounded
+# machine-wide by TRANSCODE_SLOTS, independent of the number of (network
+# bound) download daemons. Each job gets an explicit FFMPEG_THREADS budget so
+# that concurrent FFmpeg instances do not each size themselves to all cores.
+transcode_slots = max(1, int(os.environ.get("TRANSCODE_SLOTS", os.cpu_count() or 1)))
+ffmpeg_threads = max(1, int(os.environ.get(
+    "FFMPEG_THREADS", (os.cpu_count() or 1) // transcode_slots)))
+
+# Watchdog deadlines in seconds for a single download task: a download that
+# receives no bytes for DOWNLOAD_STALL_TIMEOUT, or a task that takes longer
+# than DOWNLOAD_TASK_TIMEOUT in total, is aborted.
+download_stall_timeout = float(os.environ.get("DOWNLOAD_STALL_TIMEOUT", "300"))
+download_task_timeout = float(os.environ.get("DOWNLOAD_TASK_TIMEOUT", "3600"))
+
+# Backoff schedule for tasks that failed transiently (e.g. HTTP 429). After
+# RETRY_MAX_ATTEMPTS attempts a task is parked like a permanent failure.
+retry_base_seconds = float(os.environ.get("RETRY_BASE_SECONDS", "60"))
+retry_max_seconds = float(os.environ.get("RETRY_MAX_SECONDS", "21600"))
+retry_max_attempts = int(os.environ.get("RETRY_MAX_ATTEMPTS", "8"))
+
+# Byte cap of the raw-audio cache of downloaded source streams (0 disables it)
+raw_cache_bytes = int(os.environ.get("RAW_CACHE_BYTES", "0"))
+
+# The autoscaling supervisor reconsiders the number of download daemons every
+# AUTOSCALE_INTERVAL seconds, and sheds daemons while the load average per
+# core exceeds AUTOSCALE_LOAD_LIMIT.
+autoscale_interval = float(os.environ.get("AUTOSCALE_INTERVAL", "30"))
+autoscale_load_limit = float(os.environ.get("AUTOSCALE_LOAD_LIMIT", "1.0"))
+
+# Number of pages of a Spotify playlist or album that are requested at once
+spotify_page_workers = max(1, int(os.environ.get("SPOTIFY_PAGE_WORKERS", "4")))
 
 
 # Access Spotify API
@@ -316,7 +360,8 @@ def run_clean_up(prompt=True):
     if any(daemons):
         rm_daemons = input('Delete all daemon files?  yes/[No]')
         if rm_daemons in 'Yesyes':
-            for daemon in daemons:
+            for daemon in daemons + glob(transcode_dir.format('*')) + glob(album_lock_dir.format('*')) + \
+                    glob(supervisor_path) + glob(desired_daemons_path) + glob(interactive_daemon_path):
                 os.remove(daemon)
             print('Daemons deleted.')
         else:
@@ -2,15 +2,18 @@ from initialize import log_dir, default_location
 import logging
 from logging_setup import configure_logger, close_logger_handlers
 from utils import input_is, get_url_platform, shorten_url, \
-    get_path_components, track_exists, sanitize_track_name, strip_url, flatten
+    get_path_components, track_exists, sanitize_track_name, strip_url, \
+    flatten, audio_formats
 from tag_manager import get_track_tags, manual_track_tags, get_tags_uri
 import sys
 import re
 import index
+import archive
+import sync
 from download_daemon import start_daemons
 import click
 from click import Choice
-from typing import List
+from typing import List, Tuple
 from difflib import SequenceMatcher
 import unicodedata
 from typing import Iterable, Iterator
@@ -174,7 +177,7 @@ def lookup(query: dict, platform, logger: callable = print, sort_by='none',
     search_query = f'{query["title"]} {query["artist"]}'
     qstr = search_query if len(search_query) < 47 else search_query[:44] + '...'
     logger.info('%s "%s" %s', f'Searching {platform.name.capitalize()} for:'.ljust(ps), qstr, 'srt% tim% sim%')
-    items = platform.search(search_query, **kwargs)
+    items = album_candidates(query, platform, **kwargs) or platform.search(search_query, **kwargs)
 
     # Check if one of our search results matches our query
     if not any(items):
@@ -311,6 +314,12 @@ def lookup(query: dict, platform, logger: callable = print, sort_by='none',
         else:
             logger.info(f'Invalid input "{proceed}"')
 
+    # Rank the other acceptable candidates, so that the download can fall
+    # back to them without matching again (only for audio platforms)
+    if isinstance(match, dict) and platform.target == 'track':
+        match['alternates'] = rank_alternates(
+            match, query, sorted_properties, platform, duration_tolerance)
+
     # Give it another try with our updated arguments
     if match is None and default_response is None:
         match = lookup(
@@ -322,6 +331,71 @@ def lookup(query: dict, platform, logger: callable = print, sort_by='none',
     return match
 
 
+def album_candidates(query: dict, platform, **kwargs) -> list:
+    """
+    Returns the tracks of the query's album on the platform that match the
+    query by title, artist and duration. This applies to tracks of an
+    unpacked album, of which the album is known; the tracklist of the album
+    is retrieved once for all its tracks (see spotify.album_search).
+
+    :param query: The description of the track, with its 'album'.
+    :param platform: The platform to search on.
+    :return: The matching track items, or an empty list.
+    :rtype: List[dict]
+    """
+    album_search = getattr(platform, 'album_search', None)
+    if album_search is None or not kwargs.get('batch') or not query.get('album'):
+        return []
+    items = album_search(query['album'], query['artist'], kwargs['market'])
+    if not any(items):
+        return []
+    relative_d = platform.t_extractor(*items, query_duration=query['duration'])
+    candidates = []
+    for item, duration in zip(items, relative_d):
+        item_title, item_artist = platform.item2desc(item)
+        if abs(duration - 1) < kwargs['tolerance'] and \
+                compare_meta(item_title, query['title'], item_artist, query['artist']):
+            candidates.append(item)
+    return candidates
+
+
+def rank_alternates(match: dict, query: dict, sorted_properties: list, platform,
+                    duration_tolerance: float) -> List[dict]:
+    """
+    Lists the search results other than the match that are clear matches of
+    the query, i.e. whose title and artist match (see compare_meta) and whose
+    duration is within the tolerance, in order of ranking, with their
+    similarity scores.
+
+    :param match: The meta info of the accepted search result.
+    :param query: The description of the track, with its 'title' and 'artist'.
+    :param sorted_properties: Ranked (sort key, item, relative duration,
+        title similarity) tuples of the search results.
+    :param platform: The platform that was searched.
+    :param duration_tolerance: The accepted relative duration difference.
+    :return: Meta info of the acceptable candidates, with a 'score' key.
+    :rtype: List[dict]
+    """
+    alternates = []
+    for _, item, duration, similarity in sorted_properties:
+        if duration is None or abs(duration - 1) >= duration_tolerance:
+            continue
+        if not any(platform.validate_items([item])):
+            continue
+        item_title, item_artist = platform.item2desc(item)
+        if not compare_meta(item_title, query['title'], item_artist, query['artist']):
+            continue
+        try:
+            meta_info = platform.get_meta_info(item)
+        except (KeyError, IndexError, TypeError):
+            continue
+        if meta_info['track_uri'] == match.get('track_uri'):
+            continue
+        score = similarity_mult(duration_similarity(duration), similarity)
+        alternates.append(dict(meta_info, score=score))
+    return alternates
+
+
 def file_from_tags_exists(track_tags: dict | None, logger: callable = print, avoid_duplicates=True):
     if avoid_duplicates and track_tags is not None:
         artist_p, _, track_p = get_path_components(track_tags)
@@ -330,11 +404,14 @@ def file_from_tags_exists(track_tags: dict | None, logger: callable = print, avo
     return False
 
 
-def do_match(track_url, source, logger: callable = print, **kwargs):
+def do_match(track_url, source, logger: callable = print, index_writes: list | None = None, **kwargs):
     """
         The do_match function handles the heavy lifting of the matching process.
         It is wrapped by match_audio_with_tags to enable harmonized handling of
         errors and creation of index items.
+
+        When index_writes is given, the index items are appended to it to be
+        committed as a group (see index.write_many), instead of written.
     """
     # Get the arguments
     market = kwargs['market']
@@ -342,8 +419,14 @@ def do_match(track_url, source, logger: callable = print, **kwargs):
     avoid_duplicates = kwargs['avoid_duplicates']
     track_uri = source.url2uri(track_url)
 
+    # Items that are queued for the next group commit count as indexed
+    queued = {w['uri'] for w in index_writes or ()}
+
+    def is_indexed(uri: str) -> bool:
+        return uri in queued or index.has_uri(uri)
+
     # Skip in case the URL is already in the index
-    if index.has_uri(track_uri) and not do_overwrite:
+    if is_indexed(track_uri) and not do_overwrite:
         return f'Skipped: TrackExists "{track_uri}"'
 
     # Get a description of the object to use for matching.
@@ -377,6 +460,8 @@ def do_match(track_url, source, logger: callable = print, **kwargs):
         return f'Failed: Could not match {source.name.capitalize()} to ' \
                f'{search.name.capitalize()} item'
 
+    # Runner-up audio candidates are stored with the download instructions
+    alternates = match_obj.pop('alternates', None) if isinstance(match_obj, dict) else None
     track_uri, track_tags = source.sort_lookup(query, match_obj)
     tags_uri = get_tags_uri(track_tags)
     source_uri = source.url2uri(track_url)  # 1 id may >1 urls
@@ -388,24 +473,29 @@ def do_match(track_url, source, logger: callable = print, **kwargs):
     #  2) Check if the found tracks is already in the index
     if not do_overwrite:
         ctrl = [('Tag', tags_uri), ('Track', track_uri), ('Source', source_uri)]
-        errs = [err for err, idx in ctrl if index.has_uri(idx)]
+        errs = [err for err, idx in ctrl if is_indexed(idx)]
         if any(errs):
             return ' '.join(['Skipped:', *[f'{e}Exists' for e in errs]])
 
     # Set index items
-    if tags_uri != 'manual':
-        index.write(tags_uri)
-    index.write(track_uri, tags=track_tags, settings=kwargs, overwrite=True)
+    writes = [dict(uri=tags_uri)] if tags_uri != 'manual' else []
+    writes.append(dict(uri=track_uri, tags=track_tags, settings=kwargs, overwrite=True,
+                       alternates=alternates, priority=kwargs.get('priority') or 0,
+                       batch=kwargs.get('batch')))
+    if index_writes is None:
+        index.write_many(writes)
+    else:
+        index_writes.extend(writes)
     return f'Success: Download added.\n' \
            f'    -> TAG   {tags_uri}\n' \
            f'    -> AUDIO {track_uri}'
 
 
-def match_audio_with_tags(track_url: str, **kwargs):
+def match_audio_with_tags(track_url: str, index_writes: list | None = None, **kwargs):
     """
     This function matches a given URL, and writes what it found to the index
     after which it calls this function again, but as a background process,
-    and finishes.
+    and finishes. See do_match for index_writes.
     """
     ps = kwargs['print_space']
 
@@ -424,7 +514,7 @@ def match_audio_with_tags(track_url: str, **kwargs):
         else:
             logger.info('%s %s', f'New {source.name} URL:'.ljust(ps), strip_url(track_url))
         
-        search_result = do_match(track_url, source, logger, **kwargs)
+        search_result = do_match(track_url, source, logger, index_writes=index_writes, **kwargs)
         if isinstance(search_result, tuple):
             status, tags_uri, source_uri, track_uri = search_result
             index.write(tags_uri, overwrite=False)
@@ -447,10 +537,51 @@ def match_audio_with_tags(track_url: str, **kwargs):
         # Critical: release the per-URL log file handle(s).
         close_logger_handlers(logger)
 
-def unpack_url(url: str) -> list:
+def restore_urls(urls: Iterable[str], priority: int | None = None, ps: int = 24) -> int:
+    """
+    Queues tracks again from the archive of completed index records, without
+    matching them and without calls to the platforms. Without URLs, all
+    archived tracks of which the audio file is missing are queued again.
+
+    :param urls:        URLs of tracks, of the audio or of the source of the tags
+    :param priority:    Download priority; by default that of single tracks
+    :param ps:          Whitespaces used when logging
+    :return:            The number of tracks queued
+    """
+    priority = index.interactive_priority if priority is None else priority
+    if urls:
+        uris = []
+        for url in urls:
+            platform = get_url_platform(url)
+            if platform is None:
+                print('Failed:'.ljust(ps) + f'UnknownPlatform "{url}"')
+                continue
+            uris.append(platform.url2uri(url))
+    else:
+        uris = [r['uri'] for r in archive.records()
+                if not any(track_exists(*get_path_components(r['tags'])[::2]))]
+
+    n_restored = 0
+    for uri in uris:
+        status = archive.restore(uri, priority=priority).split(':')
+        n_restored += status[0] == 'Success'
+        print(str(status[0] + ':').ljust(ps) + ':'.join(status[1:]))
+    return n_restored
+
+
+def unpack_url(url: str, do_sync: bool = False) -> Tuple[str | None, Iterable[str]]:
+    """
+    Unpacks a URL into the URLs of the tracks it refers to.
+
+    :param url:     URL of a track, playlist or album
+    :param do_sync: To unpack only the tracks added to a playlist or album
+                    since its last sync, see sync.delta
+    :return:        The batch the tracks belong to (the collection URL, or None
+                    for a single track) and the track URLs.
+    """
     # Skip empty URL
     if not url:
-        return []
+        return None, []
 
     # Anything after '&' is not of interest
     url = url.split('&')[0]
@@ -459,23 +590,32 @@ def unpack_url(url: str) -> list:
     platform = get_url_platform(url)
     if platform is None:
         print('Failed to unpack URL')
-        return []
+        return None, []
 
     url = platform.url_unshortner(url)
     # Check if the URL is a reference to a batch of tracks
     if platform.playlist_identifier in url:
-        urls = platform.playlist_handler(url)
+        handler = platform.playlist_handler
     elif platform.album_identifier in url:
-        urls = platform.album_handler(url)
+        handler = platform.album_handler
     else:
-        urls = [url]
-    return urls
+        return None, [url]
+    if do_sync:
+        return url, sync.delta(url, platform, handler)
+    return url, handler(url)
 
 
-def iter_unpacked_urls(urls: Iterable[str]) -> Iterator[str]:
+def iter_unpacked_urls(urls: Iterable[str], do_sync: bool = False) -> Iterator[Tuple[str, str | None]]:
+    # Yields (track URL, batch) pairs
     for u in urls:
-        for x in unpack_url(u):
-            yield x
+        batch, unpacked = unpack_url(u, do_sync)
+        try:
+            for x in unpacked:
+                yield x, batch
+        except Exception as e:
+            # The tracks unpacked so far are kept, but the collection is not
+            # complete; a sync does not store its snapshot
+            print(f'Failed: Unpacking "{u}" stopped: {e}')
 
 
 def main(**kwargs):
@@ -486,23 +626,47 @@ def main(**kwargs):
     headless = kwargs['headless']
     max_daemons = kwargs['max_daemons']
     verbose = kwargs['verbose']
+    scaling = dict(autoscale=kwargs['autoscale'], min_daemons=kwargs['min_daemons'])
+
+    # Queue archived tracks again instead of matching them
+    if kwargs['restore']:
+        n_restored = restore_urls(raw_urls, kwargs['priority'], ps)
+        raw_urls = ()
+        if n_restored and input_is('During', init_daemons):
+            n_started = start_daemons(max_daemons, verbose, **scaling)
+            if n_started and not verbose:
+                print(f'{n_started} DAEMONs started')
+
+    # The index items of a playlist or album are committed in groups
+    index_writes = []
 
     # Unpack URLs that contain playlists or albums
-    for url in iter_unpacked_urls(raw_urls):
+    for url, batch in iter_unpacked_urls(raw_urls, kwargs['sync']):
         # Sanitization
         # url = url.split('?')[0]
         # Do not pass the content of an entire playlist but just the specific track
         kwargs['urls'] = url
+        # Single tracks are downloaded before tracks of playlists and albums
+        priority = kwargs.get('priority')
+        if priority is None:
+            priority = index.batch_priority if batch else index.interactive_priority
         # Match audio and tags and write it to a file in the index
-        match_audio_with_tags(url, **kwargs)
+        match_audio_with_tags(url, index_writes=index_writes, **dict(kwargs, priority=priority, batch=batch))
+        if batch is None or len(index_writes) >= index.group_commit_size:
+            index.write_many(index_writes)
+            index_writes.clear()
+            sync.commit()
         # Start the daemons during the matching of further items
         if input_is('During', init_daemons):
-            n_started = start_daemons(max_daemons, verbose)
+            n_started = start_daemons(max_daemons, verbose, **scaling)
             if n_started and not verbose:
                 print(f'{n_started} DAEMONs started')
+    index.write_many(index_writes)
+    sync.commit()
+
     # Start the daemons after the matching of all items
     if input_is('After', init_daemons):
-        n_started = start_daemons(max_daemons, verbose)
+        n_started = start_daemons(max_daemons, verbose, **scaling)
         if n_started and not verbose:
             print(f'{n_started} DAEMONs started')
 
@@ -533,6 +697,10 @@ def main(**kwargs):
               help="Response when no match.")
 @click.option("-x", "--max_daemons", default=4,
               help="Maximum number of DAEMONs.")
+@click.option("-a", "--autoscale", is_flag=True, default=False,
+              help="To scale the number of DAEMONs to the queue.")
+@click.option("-s", "--min_daemons", default=1,
+              help="Minimum number of DAEMONs when autoscaling.")
 @click.option("-h", "--headless", is_flag=True, default=False,
               help="To exit when arguments have been processed.")
 @click.option("-i", "--init_daemons", default="during",
@@ -556,8 +724,22 @@ def main(**kwargs):
               help="Whitespaces used when logging.")
 @click.option("-w", "--max_time_outs", default=10,
               help="Attempts when TimeOut.")
+@click.option("-n", "--priority", default=None, type=int,
+              help="Download priority; by default single tracks precede "
+                   "playlists and albums.")
 @click.option("-q", "--quality", default=320,
               help="Audio quality in kB/s")
+@click.option("-f", "--audio_format", default="mp3",
+              type=Choice(list(audio_formats), case_sensitive=False),
+              help="Audio format; m4a and opus skip re-encoding.")
+@click.option("-e", "--embed_cover", is_flag=True, default=False,
+              help="To embed the album cover in the audio file.")
+@click.option("-y", "--sync", is_flag=True, default=False,
+              help="To queue only the tracks added to playlists and albums "
+                   "since their last sync.")
+@click.option("-R", "--restore", is_flag=True, default=False,
+              help="To queue completed tracks again from the archive, "
+                   "without matching; all missing ones if no URLs.")
 def click_processor(**kwargs):
     main(**kwargs)
 
@@ -1,10 +1,13 @@
-from initialize import spotify_api
+from initialize import spotify_api, spotify_page_workers
 from utils import _parse_retry_after_seconds
 from tag_manager import get_track_tags, manual_track_tags
 from spotipy.exceptions import SpotifyException
 import requests
 import logging
-from typing import Tuple, List
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import copy
+from typing import Tuple, List, Iterable, Iterator
 
 # PSA: strictly define all substring patterns to avoid conflicts
 # the name of the module
@@ -60,10 +63,13 @@ def url_unshortner(object_url: str) -> str:
     return object_url
 
 
-def general_handler(url: str, method) -> list:
+def general_handler(url: str, method) -> Iterator[str]:
     """
     Handles objects containing multiple tracks such as playlists and albums.
-    Returns a list of track URLs
+    Yields the track URLs in order. The first page reports the total number
+    of tracks, so the remaining pages are requested concurrently by offset,
+    SPOTIFY_PAGE_WORKERS at a time. An error on a later page is raised after
+    the tracks of the pages before it were yielded.
     :param url:     Object url
     :type url:      str
     :param method:  Method to call on the spotify_api
@@ -77,7 +83,7 @@ def general_handler(url: str, method) -> list:
     except RuntimeError as e:
         # Exhausted retries (likely heavy throttling)
         print(str(e))
-        return []
+        return
     except SpotifyException as e:
         mtd = method.__name__.capitalize()
         if e.http_status == 404:
@@ -85,37 +91,95 @@ def general_handler(url: str, method) -> list:
                   f'private')
         else:
             print(f'Unknown Spotify Error in retrieving {mtd} items')
-        return []
-    object_items = results['items']
-    while results['next']:
-        # spotify_api.next may also be throttled (HTTP 429)
+        return
+    yield from _item_urls(results['items'])
+    if not results['next']:
+        return
+
+    # The pages of an album are requested from its tracks endpoint
+    page_method = spotify_api.album_tracks if method == spotify_api.album else method
+    limit = results['limit']
+    offsets = range(results['offset'] + limit, results['total'], limit)
+
+    def get_page(offset: int) -> dict:
+        return spotify_timeout_handler(page_method, uri, limit=limit, offset=offset)
+
+    with ThreadPoolExecutor(max_workers=spotify_page_workers) as executor:
+        pages = executor.map(get_page, offsets)
         try:
-            results = spotify_timeout_handler(spotify_api.next, results)
-        except RuntimeError as e:
-            print(str(e))
-            return []
-        object_items.extend(results['items'])
-    if 'track' in object_items[0]:
-        object_items = [i['track'] for i in object_items]
-    # TODO: Somehow, sometimes t is None when multiple URLs are provided?
-    # The current line fixes it, but what happens? Potentially returns empty list for unknown reason.
-    # object_urls = [uri2url(t['id']) for t in object_items]
-    object_urls = [uri2url(t['id']) for t in object_items if t is not None and t['id'] is not None]
-
-    # omit objects that did not have a URL, such as unavailable content
-    object_urls = [u for u in object_urls if u is not None]
-    return object_urls
-
-
-def playlist_handler(url: str) -> list:
+            for page in pages:
+                yield from _item_urls(page['items'])
+        except (RuntimeError, SpotifyException):
+            # spotify_api may also be throttled (HTTP 429) on later pages. The
+            # error is raised, so that the collection is not taken as complete
+            executor.shutdown(cancel_futures=True)
+            raise
+
+
+def _item_urls(object_items: Iterable[dict | None]) -> Iterator[str]:
+    # Playlist items wrap their track; unavailable content has no track or id
+    for item in object_items:
+        if item is not None and 'track' in item:
+            item = item['track']
+        if item is not None and item.get('id') is not None:
+            yield uri2url(item['id'])
+
+
+def playlist_handler(url: str) -> Iterator[str]:
     return general_handler(url, spotify_api.playlist_items)
 
 
-def album_handler(url: str) -> list:
+def album_handler(url: str) -> Iterator[str]:
     # Forwards the album method to the general_handle
     return general_handler(url, spotify_api.album)
 
 
+def album_search(album: str, artist: str, market: str | None = None) -> tuple:
+    """
+    Finds an album by its name and artist, and returns its tracks as search
+    result items. The tracks of an album are thus matched against a single
+    tracklist, instead of with a search each.
+
+    :param album:   Name of the album
+    :param artist:  Artist(s) of the album; only the first one is searched for
+    :param market:  Spotify API market
+    :return:        Tuple of track items, like search, or an empty tuple.
+    """
+    # Callers get copies, so that they cannot alter the cached tracklist
+    return tuple(copy.deepcopy(t) for t in _album_tracks(album, artist.split('; ')[0], market))
+
+
+@lru_cache(maxsize=32)
+def _album_tracks(album: str, artist: str, market: str | None) -> tuple:
+    # Full track items of the album that matches the name and artist best
+    try:
+        results = spotify_timeout_handler(spotify_api.search, q=f'album:{album} artist:{artist}',
+                                          type='album', limit=1, market=market)
+        albums = results['albums']['items']
+        if not albums:
+            return ()
+        track_ids = [u.split('/')[-1] for u in general_handler(albums[0]['uri'], spotify_api.album)]
+        items = []
+        # Only full track objects hold the album and popularity for the tags
+        for i in range(0, len(track_ids), 50):
+            items.extend(spotify_timeout_handler(spotify_api.tracks, track_ids[i:i + 50],
+                                                 market=market)['tracks'])
+    except (RuntimeError, SpotifyException):
+        return ()
+    return tuple({**t, 'title': t['name']} for t in items if t is not None)
+
+
+def snapshot_id(url: str) -> str | None:
+    # Returns the version identifier of a playlist; albums do not change
+    if playlist_identifier not in url:
+        return None
+    try:
+        response = spotify_timeout_handler(spotify_api.playlist, url2uri(url, raw=True), fields='snapshot_id')
+    except (RuntimeError, SpotifyException):
+        return None
+    return response.get('snapshot_id')
+
+
 def sort_lookup(query: dict, matched_obj: dict | None) -> Tuple[str | None, dict | None]:
     # Sorts the mp3 URL and track tags
     track_uri = None if matched_obj is None else matched_obj['track_uri']
@@ -1,4 +1,6 @@
-from initialize import cookie_file, deno_bin, ytdlp_remote_components
+from initialize import cookie_file, deno_bin, ytdlp_remote_components, ffmpeg_bin, staging_dir, \
+    cache_dir
+import atexit
 import logging
 import os
 import yt_dlp
@@ -6,9 +8,9 @@ import json
 import random
 import time
 import requests
-from utils import input_is
+from utils import input_is, DownloadFailed
 from ytmusicapi import YTMusic
-from typing import Tuple, List
+from typing import Tuple, List, Iterator
 from pathlib import Path
 from functools import lru_cache
 
@@ -26,20 +28,123 @@ url_patterns = ['youtube.com', 'youtu.be', 'youtube.', ]
 # substring to recognize a playlist object
 playlist_identifier = '/playlist?'
 
-# substring to recognize an album object
-album_identifier = ' '  # YouTube does not have album object types
+# substring to recognize an album object (YouTube Music album browse pages)
+album_identifier = '/browse/MPREb'
 
-def playlist_handler(url: str) -> list:
+# yt-dlp format filters for codecs that YouTube serves natively. Audio in
+# these codecs is remuxed (stream copied) rather than transcoded, see
+# transcode.copyable_codecs.
+passthrough_filters = {
+    'm4a': '[ext=m4a]',
+    'opus': '[acodec=opus]',
+}
+
+
+def format_selector(codec: str, quality: int) -> str:
+    """
+    Returns the yt-dlp format selector for the smallest audio stream whose
+    bitrate satisfies the target quality. Streams in a passthrough codec are
+    preferred. If no stream reaches the target bitrate, the best audio stream
+    is downloaded instead.
+
+    :param codec:   Target container: one of mp3, m4a, opus
+    :param quality: Target bitrate in kB/s
+    :return:        A yt-dlp format selector string
+
+    Example:
+        > format_selector('mp3', 128)
+        'worstaudio[abr>=128]/bestaudio/best'
+    """
+    selectors = []
+    native = passthrough_filters.get(codec)
+    if native is not None:
+        selectors += [f'worstaudio{native}[abr>={quality}]', f'bestaudio{native}']
+    selectors += [f'worstaudio[abr>={quality}]', 'bestaudio', 'best']
+    return '/'.join(selectors)
+
+
+# Descriptions of the tracks of unpacked playlists, by URI, so that matching
+# them needs no further YouTube calls; see get_description. The tracks are
+# matched shortly after they are unpacked, so only the latest are kept.
+_descriptions = {}
+_max_descriptions = 1000
+
+
+def _remember_description(video_id: str, title: str | None, artist: str | None,
+                          duration: float | None, album: str | None = None) -> None:
+    if not (title and artist and duration):
+        return
+    _descriptions[f'{name}.{video_id}'] = {'title': title, 'artist': artist,
+                                           'album': album, 'duration': duration}
+    while len(_descriptions) > _max_descriptions:
+        del _descriptions[next(iter(_descriptions))]
+
+
+def playlist_handler(url: str) -> Iterator[str]:
+    """
+    Yields the track URLs of a YouTube (Music) playlist while it is paged in.
+    yt-dlp's flat extraction of an unprocessed playlist requests the next
+    continuation page only once the entries of the previous page were
+    consumed, so matching starts as soon as the first page has arrived. The
+    title, artist and duration of entries from auto-generated music channels
+    are kept for get_description.
+
+    :param url: URL of the playlist
+    :return:    Iterator of track URLs
+    """
     playlist_id = url.split('list=')[-1].split('&')[0]
+    ydl_opts = {'extract_flat': 'in_playlist', 'skip_download': True, 'quiet': True}
+    if cookie_file and os.path.isfile(cookie_file):
+        ydl_opts['cookiefile'] = str(cookie_file)
     try:
-        playlist = YTMusic().get_playlist(playlist_id, limit=None)
-    except Exception:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            playlist = ydl.extract_info(f'https://www.youtube.com/playlist?list={playlist_id}',
+                                        download=False, process=False)
+            for entry in playlist.get('entries') or ():
+                if entry and entry.get('id'):
+                    # Only auto-generated music channels, named "<artist> - Topic",
+                    # carry the plain artist and title; other uploads (VEVO,
+                    # re-uploads) are normalised through the regular lookup
+                    channel = entry.get('channel') or entry.get('uploader') or ''
+                    if channel.endswith(' - Topic'):
+                        _remember_description(entry['id'], entry.get('title'), channel.removesuffix(' - Topic'),
+                                              entry.get('duration'))
+                    yield f'https://www.youtube.com/watch?v={entry["id"]}'
+    except Exception as e:
+        # A playlist that was cut short must not pass for a complete one
+        logging.getLogger(__name__).warning('Unpacking playlist %s stopped: %s', playlist_id, e)
+        raise
+
+
+def album_handler(url: str) -> list:
+    """
+    Returns the track URLs of a YouTube Music album from a single get_album
+    call. The titles, artists and durations of the tracks are kept for
+    get_description, with the album name for matching against the album.
+
+    :param url: URL of the album browse page
+    :return:    List of track URLs
+    """
+    browse_id = url.split('/browse/')[-1].split('?')[0]
+    try:
+        album = YTMusic().get_album(browse_id)
+    except Exception as e:
+        logging.getLogger(__name__).warning('Unpacking album %s failed: %s', browse_id, e)
         return []
-    return [
-        f'https://www.youtube.com/watch?v={t["videoId"]}'
-        for t in playlist.get('tracks', [])
-        if t.get('videoId')
-    ]
+    album_artist = get_artist(album)
+    track_urls = []
+    for t in album.get('tracks', []):
+        if not t.get('videoId'):
+            continue
+        _remember_description(t['videoId'], t.get('title'), get_artist(t) or album_artist,
+                              t.get('duration_seconds'), album.get('title'))
+        track_urls.append(f'https://www.youtube.com/watch?v={t["videoId"]}')
+    return track_urls
+
+
+def snapshot_id(url: str) -> str | None:
+    # YouTube Music does not version playlists
+    return None
 
 
 @lru_cache(maxsize=32)
@@ -174,6 +279,8 @@ def search_yt(query: str, market, limit=1, logger: logging.Logger | None = None)
 def get_description(track_url: str, query: str | None = None, **kwargs) -> dict | None:
     """
     Receives the link to a YouTube or YouTube Music video and returns the title
+    Tracks of unpacked playlists are described from the playlist without
+    further calls.
 
     Args:
         :param query: what to search YouTube for; defaults to the URL
@@ -188,7 +295,10 @@ def get_description(track_url: str, query: str | None = None, **kwargs) -> dict
     market = kwargs['market']
     if query is None:
         track_url = track_url.split('&')[0]
-        track_uri = url2uri(track_url).split('.')[-1] if query is None else query
+        description = _descriptions.pop(url2uri(track_url), None)
+        if description is not None:
+            return {'track_url': track_url, **description}
+        track_uri = url2uri(track_url).split('.')[-1]
         meta = YTMusic().get_song(track_uri)['videoDetails']
         query = f'{meta["title"]} {meta["author"]}'
     search_result = search_yt(query, market, limit=1)[0]
@@ -235,23 +345,40 @@ def get_description(track_url: str, query: str | None = None, **kwargs) -> dict
     return description
 
 
-def audio_download(youtube_url: str, audio_fname: str | Path, quality:int, logger: logging.Logger | None = None) -> None:
-    # ydl does not need the extension
-    logger = logger or logging.getLogger(__name__)
+# Timing of the download that is currently in progress. Each daemon process
+# downloads one track at a time, so module level state suffices.
+_download_timer = {'start': None, 'first_byte': None}
+
 
-    # TODO: can paths have periods?
-    fname, codec = str(audio_fname).split(os.extsep)
+def _progress_hook(d: dict) -> None:
+    # Registers when the first media byte of the current download arrives
+    if d.get('status') == 'downloading' and _download_timer['first_byte'] is None:
+        _download_timer['first_byte'] = time.perf_counter()
+
+
+@lru_cache(maxsize=8)
+def _youtube_dl(format: str) -> yt_dlp.YoutubeDL:
+    """
+    Returns a long-lived YoutubeDL instance for the given format selector.
+
+    Reusing the instance for every track of a daemon avoids re-initializing
+    the extractors, and all daemons share one yt-dlp cache directory so that
+    the player JS and signature/nsig solutions are computed only once.
+    """
+    logger = logging.getLogger(__name__)
 
     # Configure download settings
+    # yt-dlp only downloads the source stream to the staging directory; the
+    # conversion runs separately in a bounded transcode slot.
     ydl_opts = {
-        'format': 'bestaudio/best',
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': codec,
-            'preferredquality': quality,
-        }],
-        'outtmpl': fname,
-        "ffmpeg_location": "/usr/bin/ffmpeg",
+        'format': format,
+        'outtmpl': str(staging_dir / f'{name}.%(id)s' / 'source.%(ext)s'),
+        'continuedl': True,
+        # Let stalled connections fail instead of blocking the daemon
+        'socket_timeout': 30,
+        'cachedir': str(cache_dir / 'yt-dlp'),
+        'progress_hooks': [_progress_hook],
+        "ffmpeg_location": ffmpeg_bin,
     }
 
     # --- EJS / JS challenge solving (YouTube) ---
@@ -269,23 +396,63 @@ def audio_download(youtube_url: str, audio_fname: str | Path, quality:int, logge
             ydl_opts["remote_components"] = comps
     else:
         logger.warning("DENO_BIN not configured/found; YouTube signature solving may fail")
-    
+
     if cookie_file:
         if os.path.isfile(cookie_file):
             print('Cookie file found:', cookie_file)
             ydl_opts.update({'cookiefile': str(cookie_file)})
         else:
             logger.warning('Provided cookiefile does not exist. Ignored.')
+
+    ydl = yt_dlp.YoutubeDL(ydl_opts)
+    # Close on exit instead of per track, so that cookies are still saved
+    atexit.register(ydl.close)
+    return ydl
+
+
+def source_download(youtube_url: str, codec: str, quality: int,
+                    logger: logging.Logger | None = None) -> dict | None:
+    """
+    Downloads the source audio stream of a YouTube video to its staging
+    directory (STAGING_DIR/youtube.<videoId>). Partial downloads are kept
+    there, so an interrupted download continues from the last received byte.
+
+    :param youtube_url: URL of the video
+    :param codec:       Target container, used to prefer passthrough streams
+    :param quality:     Target bitrate in kB/s
+    :param logger:      logging object
+    :return:            Path, codec and size of the source stream.
+    :raise DownloadFailed: When the download failed.
+    """
+    logger = logger or logging.getLogger(__name__)
+
+    # We download the smallest stream that satisfies the target bitrate, and
+    # for passthrough codecs prefer a stream that already has the target
+    # codec, so it is remuxed instead of re-encoded.
+    ydl = _youtube_dl(format_selector(codec, quality))
+
     # Attempt download
+    _download_timer.update(start=time.perf_counter(), first_byte=None)
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([youtube_url])
+        info = ydl.extract_info(youtube_url, download=True)
+        source_fname = info['requested_downloads'][0]['filepath']
         logger.info('YouTube download successful')
-    except BaseException as e:
+    except Exception as e:
         logger.error('YouTube download failed: %s', e)
         if not cookie_file:
             logger.warning('Warning: No COOKIE_FILE was found. Without COOKIE_FILE '
                    'file restricted download will fail.')
+        raise DownloadFailed(str(e)) from e
+    finally:
+        start, first_byte = _download_timer['start'], _download_timer['first_byte']
+        logger.info('Time to first byte: %s, total download time: %.2fs',
+                    'N/A' if first_byte is None else f'{first_byte - start:.2f}s',
+                    time.perf_counter() - start)
+
+    n_bytes = os.path.getsize(source_fname)
+    logger.info('Downloaded format %s (%s, %s kB/s): %d bytes', info.get('format_id'),
+                info.get('acodec'), info.get('abr'), n_bytes)
+    return {'path': source_fname, 'acodec': info.get('acodec'), 'abr': info.get('abr'), 'bytes': n_bytes}
 
 
 def search(search_query, **kwargs) -> List[dict]:
@@ -0,0 +1,176 @@
+from initialize import raw_cache_dir, raw_cache_bytes, Path
+from transcode import copyable_codecs
+from utils import json_in, json_out, claim_lock
+import logging
+import os
+import shutil
+import time
+from contextlib import contextmanager
+
+# The raw-audio cache keeps the source streams downloaded from YouTube, keyed by
+# the URI of the video (e.g. youtube.<videoId>), so that re-encodes and
+# re-placements of a track are served from local disk. The least recently used
+# streams are evicted when the cache exceeds RAW_CACHE_BYTES. A cap of 0
+# disables the cache.
+
+stats_path = raw_cache_dir / 'stats.json'
+lock_path = raw_cache_dir / 'cache.lock'
+
+
+def is_enabled() -> bool:
+    return raw_cache_bytes > 0
+
+
+@contextmanager
+def _locked(poll_seconds: float = 0.1):
+    # Serializes stores, evictions and statistics updates between daemons
+    raw_cache_dir.mkdir(parents=True, exist_ok=True)
+    while not claim_lock(lock_path):
+        time.sleep(poll_seconds)
+    try:
+        yield
+    finally:
+        try:
+            lock_path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _meta_path(uri: str) -> Path:
+    return raw_cache_dir / f'{uri}.json'
+
+
+def _link_or_copy(source: Path, target: Path) -> None:
+    # A hard link costs no I/O when the cache and staging share a file system
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def _count(**increments) -> None:
+    stats = (json_in(stats_path) if stats_path.is_file() else None) or {}
+    for key, n in increments.items():
+        stats[key] = stats.get(key, 0) + n
+    json_out(stats, stats_path)
+
+
+def stats() -> dict:
+    """
+    Returns the statistics of the cache: hits, misses, stores, evictions,
+    evicted_bytes, and the current number of entries and bytes.
+    """
+    stats = (json_in(stats_path) if stats_path.is_file() else None) or {}
+    entries = _entries()
+    stats.update(entries=len(entries), bytes=sum(size for _, _, size in entries), cap=raw_cache_bytes)
+    return stats
+
+
+def _entries() -> list:
+    # (last use, uri, size) of all cached streams
+    entries = []
+    for meta_path in raw_cache_dir.glob('*.json'):
+        if meta_path == stats_path:
+            continue
+        try:
+            meta = json_in(meta_path) or {}
+            entries.append((meta_path.stat().st_mtime, meta_path.stem, meta['bytes']))
+        except (OSError, KeyError, TypeError):
+            continue
+    return entries
+
+
+def fetch(uri: str, codec: str, quality: int, target_dir: Path,
+          logger: logging.Logger | None = None) -> dict | None:
+    """
+    Places the cached source stream of a video in target_dir, if the cache holds
+    a stream that suits the requested codec and quality.
+
+    :param uri:         URI of the video
+    :param codec:       Target container: one of mp3, m4a, opus
+    :param quality:     Target bitrate in kB/s
+    :param target_dir:  Staging directory of the task
+    :param logger:      logging object
+    :return:            Path, codec and size of the source stream, like
+                        youtube.source_download, or None on a miss.
+    """
+    if not is_enabled():
+        return None
+    logger = logger or logging.getLogger(__name__)
+    meta_path = _meta_path(uri)
+    with _locked():
+        meta = (json_in(meta_path) if meta_path.is_file() else None) or {}
+        cached = raw_cache_dir / f"{uri}.{meta.get('ext')}"
+        # A stream that was selected for a lower quality, or for another
+        # passthrough codec, may not be the stream we would download now
+        acodec = meta.get('acodec') or ''
+        suits_quality = meta.get('quality', 0) >= quality or (meta.get('abr') or 0) >= quality
+        suits_codec = (codec == meta.get('audio_format') or codec == 'mp3'
+                       or acodec.startswith(copyable_codecs.get(codec, ())))
+        if not (meta and cached.is_file() and suits_quality and suits_codec):
+            _count(misses=1)
+            return None
+        target_dir.mkdir(parents=True, exist_ok=True)
+        target = target_dir / f"source.{meta['ext']}"
+        if target.exists():
+            target.unlink()
+        _link_or_copy(cached, target)
+        os.utime(meta_path)
+        _count(hits=1)
+    logger.info('Raw audio cache hit: %s (%s, %d bytes)', uri, acodec, meta['bytes'])
+    return {'path': str(target), 'acodec': meta.get('acodec'), 'abr': meta.get('abr'),
+            'bytes': meta['bytes']}
+
+
+def store(uri: str, source: dict, codec: str, quality: int, logger: logging.Logger | None = None) -> None:
+    """
+    Adds a downloaded source stream to the cache and evicts the least recently
+    used streams while the cache exceeds its cap.
+
+    :param uri:         URI of the video
+    :param source:      Source stream as returned by youtube.source_download
+    :param codec:       Target container the stream was selected for
+    :param quality:     Target bitrate the stream was selected for
+    :param logger:      logging object
+    """
+    if not is_enabled():
+        return
+    logger = logger or logging.getLogger(__name__)
+    path = Path(source['path'])
+    n_bytes = path.stat().st_size
+    if n_bytes > raw_cache_bytes:
+        return
+    ext = path.suffix.lstrip('.')
+    with _locked():
+        for old in raw_cache_dir.glob(f'{uri}.*'):
+            if old.suffix != '.json':
+                old.unlink()
+        _link_or_copy(path, raw_cache_dir / f'{uri}.{ext}')
+        json_out({'ext': ext, 'acodec': source.get('acodec'), 'abr': source.get('abr'),
+                  'bytes': n_bytes, 'audio_format': codec, 'quality': quality}, _meta_path(uri))
+        _count(stores=1)
+
+        # Evict the least recently used streams
+        entries = sorted(_entries())
+        total = sum(size for _, _, size in entries)
+        n_evicted = evicted_bytes = 0
+        for _, old_uri, size in entries:
+            if total <= raw_cache_bytes:
+                break
+            meta = json_in(_meta_path(old_uri)) or {}
+            for old in (raw_cache_dir / f"{old_uri}.{meta.get('ext')}", _meta_path(old_uri)):
+                try:
+                    old.unlink()
+                except FileNotFoundError:
+                    pass
+            total -= size
+            n_evicted += 1
+            evicted_bytes += size
+        if n_evicted:
+            _count(evictions=n_evicted, evicted_bytes=evicted_bytes)
+            logger.info('Raw audio cache evicted %d stream(s), %d bytes', n_evicted, evicted_bytes)
+
+
+if __name__ == '__main__':
+    for k, v in sorted(stats().items()):
+        print(k.ljust(20), v)
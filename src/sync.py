@@ -0,0 +1,80 @@
+from initialize import snapshots_path, Path
+from utils import json_in, json_out
+import hashlib
+import time
+from typing import Callable, Iterable, Iterator
+
+# A snapshot stores the track URIs of a playlist or album as of the last sync,
+# and the version identifier of the collection where the platform provides
+# one (Spotify's snapshot_id). A sync only yields the tracks that were added
+# since, and does not unpack a collection of which the version did not change.
+
+# Snapshots of collections that were fully unpacked, but of which the index
+# items may not be committed yet, see commit
+_pending = []
+
+
+def snapshot_path(url: str) -> Path:
+    return snapshots_path / f'{hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]}.json'
+
+
+def read_snapshot(url: str) -> dict | None:
+    """
+    Reads the snapshot of a collection.
+
+    :param url:     URL of the playlist or album
+    :return:        The snapshot with the url, snapshot_id, uris and synced
+                    time, or None if the collection was never synced.
+    """
+    path = snapshot_path(url)
+    return (json_in(path) if path.is_file() else None) or None
+
+
+def delta(url: str, platform, handler: Callable[[str], Iterable[str]], ps: int = 24) -> Iterator[str]:
+    """
+    Yields the URLs of the tracks that were added to a collection since its
+    last sync. Once all tracks were unpacked, the new snapshot is stored by
+    the next call of commit.
+
+    :param url:         URL of the playlist or album
+    :param platform:    The platform module of the URL
+    :param handler:     Unpacks the URL into track URLs, e.g. playlist_handler
+    :param ps:          Whitespaces used when logging
+    :return:            Iterator of track URLs
+    """
+    snapshot = read_snapshot(url) or {}
+    get_snapshot_id = getattr(platform, 'snapshot_id', None)
+    snapshot_id = None if get_snapshot_id is None else get_snapshot_id(url)
+    if snapshot_id is not None and snapshot_id == snapshot.get('snapshot_id'):
+        print('Unchanged:'.ljust(ps) + url)
+        return
+
+    known = set(snapshot.get('uris', ()))
+    uris = []
+    n_added = 0
+    for track_url in handler(url):
+        uri = platform.url2uri(track_url)
+        uris.append(uri)
+        if uri not in known:
+            n_added += 1
+            yield track_url
+
+    if not uris:
+        # The collection could not be unpacked; keep the previous snapshot
+        return
+    _pending.append({'url': url, 'snapshot_id': snapshot_id, 'uris': uris, 'synced': time.time()})
+    print('Synced:'.ljust(ps) + f'{n_added} new of {len(uris)} tracks in {url}')
+
+
+def commit() -> None:
+    """
+    Stores the snapshots of the collections that were fully unpacked. Call it
+    after the index items of all yielded tracks were committed, so that a
+    crash before then makes the next sync yield those tracks again.
+
+    :return:    None.
+    """
+    while _pending:
+        snapshot = _pending.pop(0)
+        snapshots_path.mkdir(exist_ok=True)
+        json_out(snapshot, snapshot_path(snapshot['url']))
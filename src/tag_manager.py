@@ -1,10 +1,15 @@
 from initialize import spotify_api
-from utils import input_is, flatten, timeout_handler
+from utils import input_is, flatten, timeout_handler, single_flight
 from datetime import datetime
 import logging
 import eyed3
+from eyed3.id3 import Tag as ID3Tag
+from eyed3.id3.frames import ImageFrame
+import base64
+import re
 import requests
-import shutil
+import struct
+import os
 from typing import Dict
 
 eyed3.log.setLevel("ERROR")
@@ -15,6 +20,30 @@ _ARTIST_GENRES_CACHE: dict[str, str] = {}
 _ALBUM_DISC_MAX_CACHE: dict[str, int] = {}
 _ARTIST_IMAGE_CACHE: dict[str, str | None] = {}
 
+# Tag dict keys and the corresponding FFmpeg metadata fields of the
+# passthrough containers.
+_MP4_FIELDS = {
+    'title': 'title',
+    'artist': 'artist',
+    'album': 'album',
+    'album_artist': 'album_artist',
+    'genre': 'genre',
+    'release_date': 'date',
+}
+_VORBIS_FIELDS = {
+    'title': 'title',
+    'artist': 'artist',
+    'album': 'album',
+    'album_artist': 'albumartist',
+    'genre': 'genre',
+    'release_date': 'date',
+    'track_num': 'tracknumber',
+    'track_max': 'tracktotal',
+    'disc_num': 'discnumber',
+    'disc_max': 'disctotal',
+    'internet_radio_url': 'source',
+}
+
 def get_tags_uri(track_tags: dict) -> str:
     """
     Returns the URI of the source of the tags
@@ -84,7 +113,10 @@ def get_track_tags(track_item: dict, do_light: bool = False, logger: logging.Log
         img_url = _ARTIST_IMAGE_CACHE.get(a_uri)
 
         if g_str is None or a_uri not in _ARTIST_IMAGE_CACHE:
-            a_meta = timeout_handler(
+            # Concurrent processes tagging the same artist share one request
+            a_meta = single_flight(
+                f'spotify-artist:{a_uri}',
+                timeout_handler,
                 func=spotify_api.artist,
                 artist_id=a_uri,
                 _logger=logger,
@@ -172,8 +204,7 @@ def manual_track_tags(market, duration=None, print_space=24) -> dict:
     return tag_series
 
 
-def set_file_tags(mp3_tags: dict, file_name: str, audio_source_url=None,
-                  logger: callable = print):
+def _set_id3_fields(tag: ID3Tag, mp3_tags: dict, audio_source_url=None) -> None:
     # Drop None values from tags
     mp3_tags = {k: v for k, v in mp3_tags.items() if v is not None}
 
@@ -182,51 +213,151 @@ def set_file_tags(mp3_tags: dict, file_name: str, audio_source_url=None,
     mp3_tags['track_num'] = (mp3_tags['track_num'], mp3_tags.pop('track_max'))
     mp3_tags['disc_num'] = (mp3_tags['disc_num'], mp3_tags.pop('disc_max'))
 
-    # Load the audio file
-    logger = logger or logging.getLogger(__name__)
-
-    audiofile = eyed3.load(file_name)
-
     # Set the track metadata
     for args in mp3_tags.items():
-        audiofile.tag.__setattr__(*args)
+        tag.__setattr__(*args)
 
     # Set some additional fields, logging our tagging process
     if audio_source_url is not None:
-        audiofile.tag.audio_source_url = audio_source_url
+        tag.audio_source_url = audio_source_url
         internet_radio_url = mp3_tags['internet_radio_url']
         # TODO: why is the internet_radio_url not set when the audio_source_url
         #  is None?
-        audiofile.tag.comments.set(
+        tag.comments.set(
             f'Audio Source: "{audio_source_url},'
             f'Meta Data Source: "{internet_radio_url}",'
         )
-    audiofile.tag.save()
-    logger.info('Successfully written file meta data')
 
 
-def download_cover_img(cover_img_path: str, cover_img_url: str, logger: logging.Logger | None = None,
-                       print_space=24):
-    """ Downloads an image from a URL and stores at a given path."""
-    # Retrieve image
+def write_id3_header(mp3_tags: dict, file_name: str, audio_source_url=None, cover_path=None,
+                     logger: logging.Logger | None = None) -> int:
+    """
+    Starts an MP3 file with its ID3 tag, and the cover when given. The audio
+    frames are appended to the file afterwards, so that the tag is written in
+    the same pass as the audio, instead of rewriting the whole file to make
+    room for it.
+
+    :param mp3_tags:            Track tags
+    :param file_name:           Path of the MP3 file to start
+    :param audio_source_url:    URL the audio was downloaded from
+    :param cover_path:          Path of a JPEG to embed as front cover
+    :param logger:              logging object
+    :return:                    Size of the tag in bytes
+    """
     logger = logger or logging.getLogger(__name__)
+    open(file_name, 'wb').close()
+    tag = ID3Tag()
+    _set_id3_fields(tag, mp3_tags, audio_source_url)
+    if cover_path is not None:
+        with open(cover_path, 'rb') as f:
+            tag.images.set(ImageFrame.FRONT_COVER, f.read(), 'image/jpeg')
+    tag.save(str(file_name))
+    logger.info('Successfully written file meta data')
+    return os.path.getsize(file_name)
+
+
+def _ffmetadata_escape(value) -> str:
+    # Special characters of the FFmpeg metadata file format are escaped
+    return re.sub(r'([=;#\\\n])', r'\\\1', str(value))
+
+
+def _flac_picture(cover_path) -> str:
+    # Ogg files embed a cover as a base64 FLAC picture block (type 3: front cover)
+    with open(cover_path, 'rb') as f:
+        data = f.read()
+    mime = b'image/jpeg'
+    block = (struct.pack('>II', 3, len(mime)) + mime + struct.pack('>I', 0)
+             + struct.pack('>IIIII', 0, 0, 0, 0, len(data)) + data)
+    return base64.b64encode(block).decode('ascii')
 
+
+def ffmetadata(tags: dict, audio_format: str, audio_source_url=None, cover_path=None) -> str:
+    """
+    Renders the tags of an m4a or opus file as an FFmpeg metadata file, so that
+    FFmpeg writes them while it remuxes the audio. An m4a cover is passed to
+    FFmpeg as an extra input; an opus cover is part of the metadata.
+
+    :param tags:                Track tags
+    :param audio_format:        m4a or opus
+    :param audio_source_url:    URL the audio was downloaded from
+    :param cover_path:          Path of a JPEG to embed as front cover (opus)
+    :return:                    Content of the metadata file
+    """
+    fields = {}
+    comment = _source_comment(tags, audio_source_url)
+    if audio_format == 'm4a':
+        for key, field in _MP4_FIELDS.items():
+            if tags.get(key) is not None:
+                fields[field] = tags[key]
+        for field, keys in (('track', ('track_num', 'track_max')), ('disc', ('disc_num', 'disc_max'))):
+            pair = _number_pair(tags, *keys)
+            if pair is not None:
+                fields[field] = '%d/%d' % pair if pair[1] else '%d' % pair[0]
+    else:
+        for key, field in _VORBIS_FIELDS.items():
+            if tags.get(key) is not None:
+                fields[field] = tags[key]
+        if audio_source_url is not None:
+            fields['website'] = audio_source_url
+        if cover_path is not None:
+            fields['METADATA_BLOCK_PICTURE'] = _flac_picture(cover_path)
+    if comment is not None:
+        fields['comment'] = comment
+    lines = [';FFMETADATA1'] + [f'{k}={_ffmetadata_escape(v)}' for k, v in fields.items()]
+    return '\n'.join(lines) + '\n'
+
+
+def _number_pair(tags: dict, num_key: str, max_key: str) -> tuple | None:
+    # Track and disc numbers may be stored as strings by the manual handler,
+    # also in the "3/12" form; None when there is no number
+    num, _, max_ = str(tags.get(num_key) or '').partition('/')
+    max_ = str(tags.get(max_key) or '') or max_
+    try:
+        num = int(num)
+    except ValueError:
+        return None
+    try:
+        max_ = int(max_)
+    except ValueError:
+        max_ = 0
+    return (num, max_) if num > 0 else None
+
+
+def _source_comment(tags: dict, audio_source_url) -> str | None:
+    # Mirrors the comment that is written to MP3 files
+    if audio_source_url is None:
+        return None
+    return (f'Audio Source: "{audio_source_url},'
+            f'Meta Data Source: "{tags.get("internet_radio_url")}",')
+
+
+def fetch_image(img_url: str) -> bytes:
+    """ Retrieves the content of an image URL."""
     # Don't allow this to block forever on a flaky network
-    res = requests.get(cover_img_url, stream=True, timeout=15)
+    res = requests.get(img_url, timeout=15)
     if res.status_code == 429:
         # Let higher-level callers apply Retry-After based backoff
         raise requests.exceptions.HTTPError("HTTP 429", response=res)
-    # Save image
-    if res.status_code == 200:
-        try:
-            with open(cover_img_path, 'wb') as f:
-                shutil.copyfileobj(res.raw, f)
-            logger.info('%s "%s"', 'Image Downloaded'.ljust(print_space), cover_img_path)
-        except FileNotFoundError as e:
-            raise FileNotFoundError(f'This folder was not suitable: "'
-                                    f'{cover_img_path}"')
-    else:
+    if res.status_code != 200:
         raise ConnectionError('Album cover image could not be retrieved.')
+    return res.content
+
+
+def download_cover_img(cover_img_path: str, cover_img_url: str, logger: logging.Logger | None = None,
+                       print_space=24):
+    """ Downloads an image from a URL and stores at a given path."""
+    # Retrieve image; daemons that need the same image at the same time share one download
+    logger = logger or logging.getLogger(__name__)
+    content = single_flight(f'image:{cover_img_url}', fetch_image, cover_img_url)
+
+    # Save image
+    try:
+        with open(cover_img_path, 'wb') as f:
+            f.write(content)
+        logger.info('%s "%s"', 'Image Downloaded'.ljust(print_space), cover_img_path)
+    except FileNotFoundError as e:
+        raise FileNotFoundError(f'This folder was not suitable: "'
+                                f'{cover_img_path}"')
 
 
 # def get_file_tags(file_name=None, tags=None) -> dict:
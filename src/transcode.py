@@ -0,0 +1,134 @@
+from initialize import transcode_dir, transcode_slots, ffmpeg_threads, ffmpeg_bin, Path
+from utils import claim_lock
+import logging
+import subprocess
+import time
+from contextlib import contextmanager, nullcontext
+
+# Source codecs (as reported by yt-dlp) that can be stream copied into the
+# given target container without re-encoding.
+copyable_codecs = {
+    'mp3': ('mp3',),
+    'm4a': ('mp4a', 'aac'),
+    'opus': ('opus',),
+}
+
+# Encoders used when the source codec does not match the target container.
+encoders = {
+    'mp3': 'libmp3lame',
+    'm4a': 'aac',
+    'opus': 'libopus',
+}
+
+
+@contextmanager
+def transcode_slot(poll_seconds: float = 0.5, logger: logging.Logger | None = None):
+    """
+    Claims one of the machine-wide transcode slots, waiting until one frees up.
+
+    The slots form a bounded pool shared by all daemons, so the number of
+    concurrent FFmpeg jobs never exceeds TRANSCODE_SLOTS, however many
+    download daemons are running.
+
+    :param poll_seconds:    Seconds to wait between attempts to claim a slot.
+    :param logger:          logging object
+    :return:                The index of the claimed slot.
+    """
+    logger = logger or logging.getLogger(__name__)
+    slot = None
+    waiting_since = time.monotonic()
+    Path(transcode_dir).parent.mkdir(parents=True, exist_ok=True)
+    while slot is None:
+        slot = next((n for n in range(transcode_slots)
+                     if claim_lock(transcode_dir.format(n))), None)
+        if slot is None:
+            time.sleep(poll_seconds)
+    waited = time.monotonic() - waiting_since
+    if waited >= poll_seconds:
+        logger.info('Waited %.1fs for a transcode slot', waited)
+    try:
+        yield slot
+    finally:
+        try:
+            transcode_dir.format(slot).unlink()
+        except FileNotFoundError:
+            pass
+
+
+def ffmpeg_args(source: str | Path, target: str | Path, codec: str, quality: int,
+                source_codec: str | None = None, threads: int | None = None,
+                metadata: str | Path | None = None, cover: str | Path | None = None,
+                append: bool = False) -> list:
+    """
+    Builds the FFmpeg command line to convert a downloaded source stream.
+
+    :param source:          Path of the downloaded source media
+    :param target:          Path of the audio file to produce
+    :param codec:           Target container: one of mp3, m4a, opus
+    :param quality:         Target bitrate in kB/s when encoding
+    :param source_codec:    Audio codec of the source as reported by yt-dlp
+    :param threads:         FFmpeg thread budget (defaults to FFMPEG_THREADS)
+    :param metadata:        FFmpeg metadata file with the tags to write
+    :param cover:           Image to embed as attached picture
+    :param append:          Write the MP3 stream to stdout, without ID3 tag, to
+                            append it to a file that holds the tag already
+    :return:                Argument list to pass to subprocess
+    """
+    threads = ffmpeg_threads if threads is None else threads
+    args = [ffmpeg_bin, '-nostdin', '-hide_banner', '-loglevel', 'error', '-y',
+            '-threads', str(threads), '-i', str(source)]
+    for extra in (metadata, cover):
+        if extra is not None:
+            args += ['-i', str(extra)]
+    args += ['-map', '0:a:0', '-threads', str(threads)]
+    n_input = 1
+    if metadata is not None:
+        args += ['-map_metadata', str(n_input)]
+        n_input += 1
+    else:
+        # Tags of the source, e.g. of a reused audio file, are not carried over
+        args += ['-map_metadata', '-1']
+    if cover is not None:
+        args += ['-map', f'{n_input}:v:0', '-c:v', 'copy', '-disposition:v:0', 'attached_pic']
+    if source_codec and source_codec.startswith(copyable_codecs.get(codec, ())):
+        args += ['-c:a', 'copy']
+    else:
+        args += ['-c:a', encoders[codec], '-b:a', f'{quality}k']
+    if append:
+        # Without ID3v2 tag, and without Xing frame, which a pipe cannot seek back to
+        return args + ['-f', 'mp3', '-id3v2_version', '0', '-write_xing', '0', 'pipe:1']
+    return args + [str(target)]
+
+
+def transcode(source: str | Path, target: str | Path, codec: str, quality: int,
+              source_codec: str | None = None, logger: logging.Logger | None = None,
+              metadata: str | Path | None = None, cover: str | Path | None = None,
+              append: bool = False) -> int:
+    """
+    Converts a downloaded source stream to the target audio file within one
+    of the bounded transcode slots. Tags and cover are written in the same
+    pass. Raises subprocess.CalledProcessError when FFmpeg fails.
+
+    :param source:          Path of the downloaded source media
+    :param target:          Path of the audio file to produce
+    :param codec:           Target container: one of mp3, m4a, opus
+    :param quality:         Target bitrate in kB/s when encoding
+    :param source_codec:    Audio codec of the source as reported by yt-dlp
+    :param logger:          logging object
+    :param metadata:        FFmpeg metadata file with the tags to write
+    :param cover:           Image to embed as attached picture
+    :param append:          Append the MP3 stream to target, which holds its ID3 tag
+    :return:                Size of the target file in bytes
+    """
+    logger = logger or logging.getLogger(__name__)
+    args = ffmpeg_args(source, target, codec, quality, source_codec,
+                       metadata=metadata, cover=cover, append=append)
+    with transcode_slot(logger=logger) as slot:
+        start = time.monotonic()
+        with open(target, 'ab') if append else nullcontext() as out:
+            subprocess.run(args, check=True, stdin=subprocess.DEVNULL,
+                           stdout=out or subprocess.DEVNULL, stderr=subprocess.PIPE)
+    method = 'Remuxed' if '-c:a' in args and args[args.index('-c:a') + 1] == 'copy' else 'Transcoded'
+    logger.info('%s in %.1fs (slot %d, %d threads)', method,
+                time.monotonic() - start, slot, ffmpeg_threads)
+    return Path(target).stat().st_size
@@ -1,5 +1,8 @@
-from initialize import music_dir, Path
+from initialize import music_dir, cache_dir, Path
+import hashlib
+import math
 import pickle
+import struct
 import os
 import inspect
 from datetime import datetime
@@ -7,7 +10,7 @@ import json
 import sys
 import re
 from glob import iglob
-from time import sleep
+from time import sleep, time as now
 import random
 from importlib import import_module
 from json.decoder import JSONDecodeError
@@ -22,6 +25,10 @@ from types import ModuleType
 import pkgutil
 
 
+# Audio containers that can be produced; mp3 is transcoded, others remuxed
+audio_formats = ('mp3', 'm4a', 'opus')
+
+
 @lru_cache(maxsize=1)
 def _build_platform_pattern_index() -> dict[str, str]:
     """
@@ -374,12 +381,14 @@ def track_exists(artist_p: str, track_p: str, logger: logging.Logger | None = No
         re.IGNORECASE | re.UNICODE,
     )
 
-    glob_pat = os.path.join(music_dir, artist_p, "*", "*.mp3")
+    glob_pat = os.path.join(music_dir, artist_p, "*", "*.*")
     matches: list[str] = []
 
     # Stream results; no intermediate "filenames = [...]"
     for fpath in iglob(glob_pat):
         fn = os.path.basename(fpath)
+        if fn.rsplit(os.extsep, 1)[-1].lower() not in audio_formats:
+            continue
         if pattern.search(fn):
             matches.append(fn)
 
@@ -549,6 +558,297 @@ def general_timeout_handler(func, *args, **kwargs):
 timeout_handler = general_timeout_handler
 
 
+class BloomFilter:
+    """
+    Compact set of strings for membership checks. A check can return a false
+    positive (at about error_rate), but never a false negative, so a miss is
+    definite.
+
+    :param capacity:    Number of items the filter is sized for
+    :param error_rate:  False positive rate at capacity
+    """
+    header = struct.Struct('>QII')
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = max(1, capacity)
+        n_bytes = max(1, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2 / 8))
+        self.n_bits = n_bytes * 8
+        self.n_hashes = max(1, round(self.n_bits / self.capacity * math.log(2)))
+        self.bits = bytearray(n_bytes)
+        self.count = 0
+
+    def _positions(self, item: str):
+        # Double hashing: k positions from one 128-bit digest
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big') | 1
+        return ((h1 + i * h2) % self.n_bits for i in range(self.n_hashes))
+
+    def add(self, item: str) -> None:
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+    def to_bytes(self) -> bytes:
+        return self.header.pack(self.capacity, self.n_hashes, self.count) + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'BloomFilter':
+        capacity, n_hashes, count = cls.header.unpack_from(data)
+        bloom = cls.__new__(cls)
+        bloom.capacity, bloom.n_hashes, bloom.count = capacity, n_hashes, count
+        bloom.bits = bytearray(data[cls.header.size:])
+        bloom.n_bits = len(bloom.bits) * 8
+        return bloom
+
+
+class DownloadFailed(Exception):
+    """Raised when a download task could not produce its audio file."""
+
+
+# Substrings (lower case) of error messages of failures that will not go away
+# by retrying later. Any other failure is considered transient.
+permanent_error_patterns = (
+    'video unavailable',
+    'private video',
+    'has been removed',
+    'account associated with this video has been terminated',
+    'not available in your country',
+    'blocked it in your country',
+    'who has blocked it on copyright grounds',
+    'confirm your age',
+    'age-restricted',
+    'members-only',
+    'join this channel',
+)
+
+
+# Messages of failures that indicate the platform is throttling requests.
+throttle_error_patterns = (
+    '429',
+    'too many requests',
+    'rate limit',
+    'confirm you\'re not a bot',
+    'confirm you’re not a bot',
+)
+
+
+def is_throttled(error: BaseException | str) -> bool:
+    # Whether a failure signals rate limiting (HTTP 429) or a bot check
+    message = str(error).lower()
+    return any(p in message for p in throttle_error_patterns)
+
+
+def classify_error(error: BaseException | str) -> str:
+    """
+    Classifies a failure as 'permanent' (e.g. a removed, geo-blocked or
+    age-gated video) or 'transient' (e.g. HTTP 429, a bot check, a timeout or
+    a dropped connection).
+
+    Args:
+        :param error: The exception or its message.
+        :type error: BaseException | str
+
+    Returns:
+        :return: 'permanent' or 'transient'
+        :rtype: str
+
+    Example:
+        > classify_error('ERROR: [youtube] NgE5mEQiizQ: Video unavailable')
+        'permanent'
+        > classify_error('HTTP Error 429: Too Many Requests')
+        'transient'
+    """
+    message = str(error).lower()
+    if any(p in message for p in permanent_error_patterns):
+        return 'permanent'
+    return 'transient'
+
+
+def pid_is_alive(pid: int) -> bool:
+    """
+    Checks whether a process with the given PID exists.
+
+    Signal 0 does not probe but terminates processes on Windows, so there
+    every process is assumed to be alive.
+
+    :param pid: process ID
+    :return:    False only if the process certainly no longer exists
+    """
+    if os.name == 'nt' or pid <= 0:
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def claim_lock(lock_path: Path) -> bool:
+    """
+    Atomically claims a lock file shared between daemon processes. The lock
+    holds the PID of its owner, so that a lock left behind by a process that
+    died is taken over.
+
+    :param lock_path:   path of the lock file
+    :return:            True if the lock was claimed by this process
+    """
+    # O_EXCL makes claiming the lock atomic across daemon processes
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        owner = lock_owner(lock_path)
+        if owner is None or pid_is_alive(owner):
+            return False
+        # Another process may take over the same stale lock and claim it anew
+        # between our check and the removal, so takeovers are serialized by a
+        # guard, under which the owner is checked again
+        guard = Path(f'{lock_path}.takeover')
+        try:
+            os.close(os.open(guard, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            # A process that died during a takeover leaves its guard behind
+            try:
+                if now() - guard.stat().st_mtime > 10:
+                    guard.unlink()
+            except FileNotFoundError:
+                pass
+            return False
+        try:
+            if lock_owner(lock_path) != owner:
+                return False
+            os.remove(lock_path)
+        except FileNotFoundError:
+            pass
+        finally:
+            guard.unlink(missing_ok=True)
+        return claim_lock(lock_path)
+    with os.fdopen(fd, 'w') as f:
+        f.write(str(os.getpid()))
+    return True
+
+
+def lock_owner(lock_path: Path) -> int | None:
+    # PID of the process holding a lock file; None if unlocked or unreadable
+    try:
+        with open(lock_path, encoding='utf-8') as f:
+            return int(f.read() or 0)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def single_flight(key: str, fetch, *args, ttl_seconds: float = 600, poll_seconds: float = 0.2, **kwargs):
+    """
+    Coalesces concurrent fetches of the same resource across daemon processes.
+
+    The first caller of a key fetches the resource while holding a lock; callers
+    that arrive meanwhile wait for it and receive its result. Results are shared
+    for ttl_seconds. When the fetch raises, or returns None, nothing is shared
+    and a waiting caller fetches the resource itself.
+
+    :param key:             Identifies the resource, e.g. its URL or ID
+    :param fetch:           Callable that fetches the resource; its result must
+                            be picklable
+    :param args:            Arguments passed to fetch
+    :param ttl_seconds:     Seconds a result is shared with later callers
+    :param poll_seconds:    Seconds to wait between checks for the result
+    :param kwargs:          Keyword arguments passed to fetch
+    :return:                The result of fetch
+    """
+    flight_dir = Path(cache_dir) / 'flight'
+    flight_dir.mkdir(parents=True, exist_ok=True)
+    name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    lock_path = flight_dir / f'{name}.lock'
+    result_path = flight_dir / f'{name}.pickle'
+
+    def shared_result():
+        try:
+            if now() - result_path.stat().st_mtime < ttl_seconds:
+                with open(result_path, 'rb') as f:
+                    return True, pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            pass
+        return False, None
+
+    while True:
+        found, result = shared_result()
+        if found:
+            return result
+        if claim_lock(lock_path):
+            break
+        sleep(poll_seconds)
+
+    try:
+        # Another caller may have finished between the check and the claim
+        found, result = shared_result()
+        if found:
+            return result
+        result = fetch(*args, **kwargs)
+        if result is not None:
+            tmp_path = result_path.with_suffix(f'.{os.getpid()}.tmp')
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(result, f)
+            os.replace(tmp_path, result_path)
+            # Drop results that are no longer shared
+            for p in flight_dir.glob('*.pickle'):
+                try:
+                    if now() - p.stat().st_mtime >= ttl_seconds:
+                        p.unlink()
+                except FileNotFoundError:
+                    pass
+        return result
+    finally:
+        try:
+            lock_path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def kill_child_processes(pid: int | None = None) -> list[int]:
+    """
+    Kills all descendant processes (e.g. FFmpeg or deno started by yt-dlp)
+    of a process, deepest first.
+
+    Descendants are discovered through /proc, so this is a no-op on
+    platforms without procfs.
+
+    :param pid: process whose descendants to kill; defaults to this process
+    :return:    PIDs that were sent SIGKILL
+    """
+    import signal
+    pid = os.getpid() if pid is None else pid
+    children: dict[int, list[int]] = {}
+    for stat_path in iglob('/proc/[0-9]*/stat'):
+        try:
+            with open(stat_path) as f:
+                # The command name may contain spaces, so split after it
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        child = int(stat_path.split(os.sep)[2])
+        children.setdefault(int(fields[1]), []).append(child)
+
+    descendants = []
+    todo = list(children.get(pid, []))
+    while todo:
+        child = todo.pop()
+        descendants.append(child)
+        todo.extend(children.get(child, []))
+
+    killed = []
+    for child in reversed(descendants):
+        try:
+            os.kill(child, signal.SIGKILL)
+            killed.append(child)
+        except (ProcessLookupError, PermissionError):
+            pass
+    return killed
+
+
 def unique_fname(file_path: str | Path) -> str | Path:
     """
      Preserves file_path class type in last line
@@ -0,0 +1,72 @@
+import glob
+import sys
+import types
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parents[1] / 'src'))
+
+# Modules of the package that read their configuration from initialize, and
+# are thus imported anew for each test
+package_modules = ('utils', 'index', 'archive', 'sync', 'transcode', 'raw_cache', 'tag_manager',
+                   'download_daemon', 'modules.spotify', 'modules.youtube')
+
+
+class _Path(type(Path())):
+    # Like initialize.Path, with .format for the path templates
+    def format(self, *args, **kwargs):
+        return _Path(str(self).format(*args, **kwargs))
+
+
+@pytest.fixture
+def initialize(tmp_path, monkeypatch):
+    """
+    Replaces initialize, which would run the setup wizard and connect to the
+    Spotify API, with its locations in a temporary directory and its default
+    settings. Tests can change the settings before they import a module.
+    """
+    home_dir = _Path(tmp_path)
+    module = types.ModuleType('initialize')
+    module.Path = _Path
+    module.glob = lambda pathname: [_Path(p) for p in glob.glob(str(pathname))]
+    module.disp_daemons = lambda: None
+    module.home_dir = home_dir
+    module.music_dir = home_dir / 'music'
+    module.default_location = 'NL'
+    module.daemon_dir = home_dir / '.daemons' / 'daemon-{}.tmp'
+    module.log_dir = home_dir / '.logs' / '{}.{}'
+    module.transcode_dir = home_dir / '.daemons' / 'transcode-{}.tmp'
+    module.album_lock_dir = home_dir / '.daemons' / 'album-{}.tmp'
+    module.supervisor_path = home_dir / '.daemons' / 'supervisor.tmp'
+    module.desired_daemons_path = home_dir / '.daemons' / 'desired.json'
+    module.interactive_daemon_path = home_dir / '.daemons' / 'interactive.tmp'
+    module.staging_dir = home_dir / '.staging'
+    module.cache_dir = home_dir / '.cache'
+    module.raw_cache_dir = module.cache_dir / 'raw'
+    module.index_path = home_dir / 'src' / 'index'
+    module.profiles_path = home_dir / 'src' / 'profiles'
+    module.archive_path = home_dir / 'src' / 'archive.gz'
+    module.snapshots_path = home_dir / 'src' / 'snapshots'
+    module.cookie_file = None
+    module.deno_bin = ''
+    module.ytdlp_remote_components = 'ejs:github'
+    module.ffmpeg_bin = 'ffmpeg'
+    module.transcode_slots = 1
+    module.ffmpeg_threads = 1
+    module.download_stall_timeout = 300.0
+    module.download_task_timeout = 3600.0
+    module.retry_base_seconds = 60.0
+    module.retry_max_seconds = 21600.0
+    module.retry_max_attempts = 8
+    module.raw_cache_bytes = 0
+    module.autoscale_interval = 30.0
+    module.autoscale_load_limit = 1.0
+    module.spotify_page_workers = 4
+    module.spotify_api = None
+    module.index_path.mkdir(parents=True)
+    monkeypatch.setitem(sys.modules, 'initialize', module)
+    for name in package_modules:
+        monkeypatch.delitem(sys.modules, name, raising=False)
+    return module
+
@@ -0,0 +1,82 @@
+import importlib
+
+import pytest
+
+
+@pytest.fixture
+def download_daemon(initialize):
+    return importlib.import_module('download_daemon')
+
+
+@pytest.fixture
+def scaler(download_daemon):
+    return download_daemon.Autoscaler(1, 4, load_limit=1.0, settle_seconds=60)
+
+
+def decide(scaler, now: float, throughput: float = 0.0, queue_depth: int = 10, load: float = 0.5,
+           throttled: int = 0) -> int:
+    return scaler.decide(queue_depth, scaler.desired, throughput, load, throttled, now=now)
+
+
+def test_autoscaler_adds_one_daemon_per_settle_period(scaler):
+    assert decide(scaler, 1000, throughput=2.0) == 2
+    assert decide(scaler, 1030, throughput=2.0) == 2
+    assert decide(scaler, 1070, throughput=4.0) == 3
+
+
+def test_autoscaler_reverts_an_addition_without_gain(scaler):
+    assert decide(scaler, 1000, throughput=2.0) == 2
+    assert decide(scaler, 1070, throughput=2.0) == 1
+    # The link is saturated; the number is capped for a while
+    assert decide(scaler, 1140, throughput=2.0) == 1
+    assert decide(scaler, 1070 + 10 * 60 + 1, throughput=2.0) == 2
+
+
+def test_autoscaler_keeps_an_addition_made_without_completions(scaler):
+    # Long tracks: nothing completed in the window before the addition
+    assert decide(scaler, 1000, throughput=0.0) == 2
+    assert decide(scaler, 1070, throughput=0.0) == 3
+
+
+def test_autoscaler_halves_on_throttling(scaler):
+    for now in (1000, 1070, 1140):
+        decide(scaler, now, throughput=now)
+    assert scaler.desired == 4
+
+    assert decide(scaler, 1150, throttled=3) == 2
+    assert decide(scaler, 1300, throughput=1e6) == 2
+
+
+def test_autoscaler_lowers_on_cpu_load_and_stays_above_floor(scaler):
+    decide(scaler, 1000, throughput=2.0)
+
+    assert decide(scaler, 1010, load=1.5) == 1
+    assert decide(scaler, 1020, load=1.5) == 1
+
+
+def test_autoscaler_holds_without_tasks(scaler):
+    assert decide(scaler, 1000, queue_depth=0) == 1
+
+
+def test_mover_continues_after_a_failing_callback(download_daemon, tmp_path):
+    sources = []
+    for name in ('a', 'b'):
+        source = tmp_path / 'staging' / f'{name}.mp3'
+        source.parent.mkdir(exist_ok=True)
+        source.write_bytes(name.encode())
+        sources.append(source)
+    done, errors = [], []
+
+    def conclude_a():
+        raise OSError('archive unavailable')
+
+    mover = download_daemon.Mover()
+    mover.submit(sources[0], tmp_path / 'music' / 'a.mp3', on_done=conclude_a, on_error=errors.append)
+    mover.submit(sources[1], tmp_path / 'music' / 'b.mp3', on_done=lambda: done.append('b'),
+                 on_error=errors.append)
+    mover.close()
+
+    assert (tmp_path / 'music' / 'a.mp3').read_bytes() == b'a'
+    assert (tmp_path / 'music' / 'b.mp3').read_bytes() == b'b'
+    assert done == ['b']
+    assert [str(e) for e in errors] == ['archive unavailable']
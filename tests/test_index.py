@@ -0,0 +1,122 @@
+import importlib
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+
+@pytest.fixture
+def index(initialize):
+    return importlib.import_module('index')
+
+
+def dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def write_journal(index, pid: int, entries: list, committed: float = 0.0) -> Path:
+    journal = Path(str(index.journal_path).format(pid))
+    journal.write_bytes(index.dumps({'committed': committed, 'entries': entries}) + b'\n')
+    return journal
+
+
+def test_replay_applies_journal_of_dead_process(index):
+    # The items were processed before; a crash lost their writes of the commit
+    settings = {'urls': 'https://open.spotify.com/track/x', 'quality': 320, 'batch': 'album'}
+    entries = [(f'youtube.AAAAAAAAAA{i}', index._payload({'title': f'Track {i}'}, settings, batch='album')
+                .decode('utf-8')) for i in range(3)]
+    for name, _ in entries:
+        index.write(name)
+        index.os.utime(index.uri2path(name), (0, 0))
+    journal = write_journal(index, dead_pid(), entries, committed=index.time.time())
+
+    index.replay()
+
+    assert not journal.exists()
+    for i, (name, _) in enumerate(entries):
+        record = index.read(name)
+        assert record['tags'] == {'title': f'Track {i}'}
+        assert record['settings'] == settings
+        assert index.queue_info(record)['batch'] == 'album'
+    assert sorted(index.to_do()) == sorted(name for name, _ in entries)
+
+
+def test_replay_skips_journal_of_live_process(index):
+    # The group commit of a running process is still in progress
+    entries = [('youtube.BBBBBBBBBBB', index._payload({'title': 'Track'}).decode('utf-8'))]
+    journal = write_journal(index, index.os.getpid(), entries)
+
+    index.replay()
+
+    assert journal.exists()
+    assert not index.has_uri('youtube.BBBBBBBBBBB')
+
+
+def test_write_many_journals_the_group(index):
+    index.write_many([dict(uri='spotify.x', overwrite=False),
+                      dict(uri='youtube.CCCCCCCCCCC', tags={'title': 'Track'}, settings={'quality': 320})])
+
+    journal = Path(str(index.journal_path).format(index.os.getpid()))
+    assert len(journal.read_bytes().splitlines()) == 1
+    assert index.read('spotify.x') is None
+    assert index.read('youtube.CCCCCCCCCCC')['tags'] == {'title': 'Track'}
+
+
+def test_replay_keeps_items_that_changed_since_the_commit(index):
+    index.write_many([dict(uri='youtube.DDDDDDDDDDD', tags={'title': 'Track'})])
+    # The track was downloaded after the commit, then the process ended
+    index.write('youtube.DDDDDDDDDDD')
+    journal = Path(str(index.journal_path).format(index.os.getpid()))
+    ended = journal.rename(journal.with_name(index.journal_path.name.format(dead_pid())))
+
+    index.replay()
+
+    assert not ended.exists()
+    assert index.read('youtube.DDDDDDDDDDD') is None
+
+
+def test_replay_ignores_a_torn_commit(index):
+    journal = write_journal(index, dead_pid(), [])
+    with open(journal, 'ab') as f:
+        f.write(index.dumps({'committed': 0.0, 'entries': [['youtube.EEEEEEEEEEE', '{}']]})[:20])
+
+    index.replay()
+
+    assert not journal.exists()
+    assert not index.has_uri('youtube.EEEEEEEEEEE')
+
+
+def test_bloom_miss_is_checked_after_another_process_wrote(index):
+    index.write('youtube.FFFFFFFFFFF', tags={'title': 'Track'})
+    assert not index.has_uri('youtube.GGGGGGGGGGG')
+    # Another process adds an item the filter of this process does not know
+    (index.index_path / 'youtube.GGGGGGGGGGG').write_bytes(b'')
+
+    assert index.has_uri('youtube.GGGGGGGGGGG')
+    assert index.has_uri('youtube.FFFFFFFFFFF')
+
+
+def test_bloom_is_rebuilt_once_it_drifted(index, monkeypatch):
+    index.load_bloom()
+    (index.index_path / 'youtube.HHHHHHHHHHH').write_bytes(b'')
+    monkeypatch.setattr(index, 'bloom_refresh_seconds', 0)
+
+    assert index.has_uri('youtube.HHHHHHHHHHH')
+    assert 'youtube.HHHHHHHHHHH' in index._bloom
+    assert index._bloom_mtime == index._index_mtime()
+
+
+def test_persisted_bloom_is_used_only_while_the_index_is_unchanged(index, monkeypatch):
+    index.write('youtube.JJJJJJJJJJJ')
+    index.save_bloom()
+    monkeypatch.setattr(index, '_bloom', None)
+    assert 'youtube.JJJJJJJJJJJ' in index.load_bloom()
+
+    # The index changed after the filter was persisted
+    monkeypatch.setattr(index, '_bloom', None)
+    (index.index_path / 'youtube.KKKKKKKKKKK').write_bytes(b'')
+
+    assert 'youtube.KKKKKKKKKKK' in index.load_bloom()
@@ -0,0 +1,50 @@
+import importlib
+import os
+
+import pytest
+
+
+@pytest.fixture
+def raw_cache(initialize):
+    initialize.raw_cache_bytes = 10
+    return importlib.import_module('raw_cache')
+
+
+def store(raw_cache, tmp_path, uri: str, n_bytes: int, last_use: float) -> None:
+    source = tmp_path / 'staging' / uri / 'source.webm'
+    source.parent.mkdir(parents=True)
+    source.write_bytes(b'x' * n_bytes)
+    raw_cache.store(uri, {'path': str(source), 'acodec': 'opus', 'abr': 160}, 'opus', 160)
+    os.utime(raw_cache._meta_path(uri), (last_use, last_use))
+
+
+def test_store_evicts_least_recently_used(raw_cache, tmp_path):
+    store(raw_cache, tmp_path, 'youtube.AAAAAAAAAAA', 4, 1000)
+    store(raw_cache, tmp_path, 'youtube.BBBBBBBBBBB', 4, 2000)
+    # A hit makes a stream the most recently used
+    assert raw_cache.fetch('youtube.AAAAAAAAAAA', 'opus', 160, tmp_path / 'task') is not None
+
+    store(raw_cache, tmp_path, 'youtube.CCCCCCCCCCC', 4, 3000)
+
+    cached = {uri for _, uri, _ in raw_cache._entries()}
+    assert cached == {'youtube.AAAAAAAAAAA', 'youtube.CCCCCCCCCCC'}
+    assert not (raw_cache.raw_cache_dir / 'youtube.BBBBBBBBBBB.webm').exists()
+    stats = raw_cache.stats()
+    assert (stats['evictions'], stats['evicted_bytes'], stats['bytes']) == (1, 4, 8)
+
+
+def test_store_skips_streams_larger_than_the_cap(raw_cache, tmp_path):
+    store(raw_cache, tmp_path, 'youtube.AAAAAAAAAAA', 4, 1000)
+    source = tmp_path / 'source.webm'
+    source.write_bytes(b'x' * 11)
+
+    raw_cache.store('youtube.DDDDDDDDDDD', {'path': str(source), 'acodec': 'opus'}, 'opus', 160)
+
+    assert {uri for _, uri, _ in raw_cache._entries()} == {'youtube.AAAAAAAAAAA'}
+
+
+def test_fetch_misses_a_stream_of_lower_quality(raw_cache, tmp_path):
+    store(raw_cache, tmp_path, 'youtube.AAAAAAAAAAA', 4, 1000)
+
+    assert raw_cache.fetch('youtube.AAAAAAAAAAA', 'opus', 256, tmp_path / 'task') is None
+    assert raw_cache.stats()['misses'] == 1
@@ -0,0 +1,48 @@
+import importlib
+
+import pytest
+
+
+class FakeSpotify:
+    """Serves one album of three tracks and counts the requests."""
+
+    def __init__(self):
+        self.n_searches = 0
+
+    def search(self, q, type, limit, market=None):
+        self.n_searches += 1
+        return {'albums': {'items': [{'uri': 'spotify:album:ALBUM'}]}}
+
+    def album(self, uri):
+        items = [{'id': f'TRACK{i}'} for i in range(3)]
+        return {'tracks': {'items': items, 'next': None, 'limit': 50, 'offset': 0, 'total': 3}}
+
+    def tracks(self, ids, market=None):
+        return {'tracks': [{'id': i, 'name': f'Song {i}', 'duration_ms': 180000} for i in ids]}
+
+
+@pytest.fixture
+def spotify(initialize):
+    initialize.spotify_api = FakeSpotify()
+    return importlib.import_module('modules.spotify')
+
+
+def test_album_search_returns_the_tracklist_with_titles(spotify):
+    items = spotify.album_search('Album', 'Artist; Featured')
+
+    assert isinstance(items, tuple)
+    assert [(t['id'], t['title'], t['name']) for t in items] == [
+        (f'TRACK{i}', f'Song TRACK{i}', f'Song TRACK{i}') for i in range(3)]
+
+
+def test_album_search_is_cached_and_returns_copies(spotify):
+    first = spotify.album_search('Album', 'Artist')
+    first[0]['title'] = 'Changed'
+    del first[1]['name']
+
+    second = spotify.album_search('Album', 'Artist')
+
+    assert spotify.spotify_api.n_searches == 1
+    assert second[0]['title'] == 'Song TRACK0'
+    assert second[1]['name'] == 'Song TRACK1'
+    assert second[0] is not first[0]
@@ -0,0 +1,74 @@
+import base64
+import importlib
+import struct
+
+import pytest
+
+
+@pytest.fixture
+def tag_manager(initialize):
+    return importlib.import_module('tag_manager')
+
+
+@pytest.mark.parametrize('tags, pair', [
+    ({'track_num': 3, 'track_max': 12}, (3, 12)),
+    ({'track_num': '3', 'track_max': '12'}, (3, 12)),
+    ({'track_num': '3/12'}, (3, 12)),
+    ({'track_num': '3/12', 'track_max': 14}, (3, 14)),
+    ({'track_num': 3}, (3, 0)),
+    ({'track_num': 3, 'track_max': None}, (3, 0)),
+    ({'track_num': '3/x'}, (3, 0)),
+    ({'track_num': None, 'track_max': 12}, None),
+    ({'track_num': 0, 'track_max': 12}, None),
+    ({'track_num': 'A1'}, None),
+    ({}, None),
+])
+def test_number_pair(tag_manager, tags, pair):
+    assert tag_manager._number_pair(tags, 'track_num', 'track_max') == pair
+
+
+def parse(metadata: str) -> dict:
+    lines = metadata.splitlines()
+    assert lines[0] == ';FFMETADATA1'
+    return dict(line.split('=', 1) for line in lines[1:])
+
+
+def test_ffmetadata_m4a(tag_manager):
+    tags = {'title': 'Song = Title; #1', 'artist': 'Artist', 'album': 'Album', 'album_artist': 'Artist',
+            'genre': None, 'release_date': '2020-01-31', 'track_num': '3/12', 'disc_num': None,
+            'disc_max': 2, 'internet_radio_url': 'https://open.spotify.com/track/x'}
+
+    fields = parse(tag_manager.ffmetadata(tags, 'm4a', 'https://youtu.be/x'))
+
+    assert fields['title'] == r'Song \= Title\; \#1'
+    assert fields['date'] == '2020-01-31'
+    assert fields['album_artist'] == 'Artist'
+    assert fields['track'] == '3/12'
+    # Missing values are left out, instead of written as 0 or None
+    assert 'disc' not in fields
+    assert 'genre' not in fields
+    assert fields['comment'].startswith('Audio Source: "https://youtu.be/x,')
+
+
+def test_ffmetadata_m4a_track_without_total(tag_manager):
+    fields = parse(tag_manager.ffmetadata({'title': 'Song', 'track_num': 3}, 'm4a'))
+
+    assert fields == {'title': 'Song', 'track': '3'}
+
+
+def test_ffmetadata_opus_embeds_cover(tag_manager, tmp_path):
+    cover = tmp_path / 'folder.jpg'
+    cover.write_bytes(b'\xff\xd8jpeg')
+
+    fields = parse(tag_manager.ffmetadata({'title': 'Song', 'track_num': 3, 'track_max': 12}, 'opus',
+                                          'https://youtu.be/x', cover))
+
+    assert fields['title'] == 'Song'
+    assert fields['tracknumber'] == '3'
+    assert fields['tracktotal'] == '12'
+    assert fields['website'] == 'https://youtu.be/x'
+    block = base64.b64decode(fields['METADATA_BLOCK_PICTURE'])
+    picture_type, mime_length = struct.unpack_from('>II', block)
+    assert picture_type == 3
+    assert block[8:8 + mime_length] == b'image/jpeg'
+    assert block.endswith(b'\xff\xd8jpeg')
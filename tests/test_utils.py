@@ -0,0 +1,58 @@
+import importlib
+
+import pytest
+
+
+@pytest.fixture
+def utils(initialize):
+    return importlib.import_module('utils')
+
+
+@pytest.mark.parametrize('message', [
+    'ERROR: [youtube] NgE5mEQiizQ: Video unavailable',
+    'ERROR: [youtube] NgE5mEQiizQ: Private video. Sign in if you have been granted access',
+    'This video is not available in your country',
+    'Sign in to confirm your age. This video may be inappropriate for some users.',
+])
+def test_classify_error_permanent(utils, message):
+    assert utils.classify_error(message) == 'permanent'
+
+
+@pytest.mark.parametrize('error', [
+    'HTTP Error 429: Too Many Requests',
+    "Sign in to confirm you're not a bot",
+    TimeoutError('The read operation timed out'),
+    ConnectionResetError(104, 'Connection reset by peer'),
+])
+def test_classify_error_transient(utils, error):
+    assert utils.classify_error(error) == 'transient'
+
+
+def test_bloom_filter_has_no_false_negatives(utils):
+    bloom = utils.BloomFilter(1000)
+    names = [f'youtube.{i:011d}' for i in range(1000)]
+    for name in names:
+        bloom.add(name)
+
+    assert all(name in bloom for name in names)
+    assert bloom.count == 1000
+
+
+def test_bloom_filter_false_positive_rate(utils):
+    bloom = utils.BloomFilter(1000, error_rate=0.01)
+    for i in range(1000):
+        bloom.add(f'youtube.{i:011d}')
+
+    false_positives = sum(f'spotify.{i:022d}' in bloom for i in range(10000))
+    assert false_positives < 300
+
+
+def test_bloom_filter_round_trips_through_bytes(utils):
+    bloom = utils.BloomFilter(100)
+    bloom.add('youtube.AAAAAAAAAAA')
+
+    restored = utils.BloomFilter.from_bytes(bloom.to_bytes())
+
+    assert 'youtube.AAAAAAAAAAA' in restored
+    assert 'youtube.BBBBBBBBBBB' not in restored
+    assert (restored.capacity, restored.n_hashes, restored.count) == (100, bloom.n_hashes, 1)
@@ -0,0 +1,20 @@
+import importlib
+
+import pytest
+
+
+@pytest.fixture
+def youtube(initialize):
+    return importlib.import_module('modules.youtube')
+
+
+def test_format_selector_takes_the_smallest_stream_above_the_bitrate(youtube):
+    assert youtube.format_selector('mp3', 128) == 'worstaudio[abr>=128]/bestaudio/best'
+
+
+@pytest.mark.parametrize('codec, native', [('m4a', '[ext=m4a]'), ('opus', '[acodec=opus]')])
+def test_format_selector_prefers_passthrough_streams(youtube, codec, native):
+    selectors = youtube.format_selector(codec, 160).split('/')
+
+    assert selectors == [f'worstaudio{native}[abr>=160]', f'bestaudio{native}',
+                         'worstaudio[abr>=160]', 'bestaudio', 'best']